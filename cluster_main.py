@@ -1,10 +1,19 @@
-from wsi.lm_bert import trim_predictions
+from wsi.lm_bert import trim_predictions, get_vocab_filter, eligible_vocab_mask
 from wsi.WSISettings import DEFAULT_PARAMS, WSISettings
-from wsi.wsi_clustering import cluster_predictions, find_best_sents, get_cluster_centers, map_other_instances
+from wsi.predictions import load_predictions, load_vocab, prediction_columns, reduce_to_lemmas
+from wsi.reporting import render_plots
+from wsi.wsi_clustering import (cluster_predictions, find_best_sents, get_cluster_centers, 
+                                map_other_instances, dense_rows)
+from process_data import (group_by_target, target_rows, sample_cluster_subset, 
+                          save_cluster_subset, load_cluster_subset)
+from wsi.workers import fork_pool, shared_data
+from storage import read_table, write_table
 from log import record_time
+from collections import namedtuple
 from typing import List
 from pathlib import Path
 import pandas as pd
+import numpy as np
 import pickle
 
 def get_cluster_data(sense_clusters, target_data):
@@ -36,7 +45,7 @@ def prep_io(targets, output_path, plot_clusters, print_clusters,
     ## TODO: should I be saving sense sents at every step?
     ## Otherwise this isn't saving any data incrementally
     else:
-        all_sense_data = pd.read_pickle(f'{output_path}/target_sense_labels.pkl')
+        all_sense_data = read_table(f'{output_path}/target_sense_labels')
         skip_targets = all_sense_data.target.unique()
         print(f'{len(skip_targets)} targets already clustered')
         
@@ -53,6 +62,149 @@ def prep_io(targets, output_path, plot_clusters, print_clusters,
 
     return settings, logging_file, all_sense_data
 
+## What every target's clustering needs besides its own rows
+ClusterContext = namedtuple('ClusterContext', [
+    'settings', 'dataset_desc', 'min_sense_size', 'output_path', 'embed_sents',
+    'plot_clusters', 'print_clusters', 'vocab', 'lemma_ids', 'vocab_filter', 'cluster_subset'])
+
+def load_vectors(target_alts, ctx):
+    ## Instance ids, their features and the feature columns
+    ## Predictions stay a CSR matrix of the kept columns; rows are made dense as they're needed
+    target = target_alts[0]
+    settings = ctx.settings
+    if ctx.embed_sents:
+        with open(f'{ctx.output_path}/vectors/{target}.pkl', 'rb') as vp:
+            pred_vectors = pickle.load(vp)
+            pred_vectors = pd.DataFrame.from_dict(pred_vectors).T
+            return np.asarray(pred_vectors.index), pred_vectors.to_numpy(), pred_vectors.columns
+
+    predictions = load_predictions(f'{ctx.output_path}/predictions/{target}.npz')
+    # print(f'\tPredictions loaded')
+    if ctx.lemma_ids is not None:
+        predictions = reduce_to_lemmas(predictions, ctx.lemma_ids, len(ctx.vocab))
+
+    if predictions.selected is not None:
+        ## Already trimmed while predicting
+        subset_term_ids = predictions.selected
+    else:
+        subset_term_ids = trim_predictions(
+            predictions, eligible_vocab_mask(ctx.vocab_filter, target_alts),
+            settings.trim_cutoff, settings.trim_threshold)
+    subset_term_ids = np.asarray(subset_term_ids, dtype=np.int64)
+    return predictions.inst_ids, predictions.matrix[:, subset_term_ids], subset_term_ids
+
+def cluster_target(target_alts, target_subset, ctx):
+    ## Clusters one target and saves its summary and centers
+    ## Returns its sense labels and the lines for the clustering log
+    target = target_alts[0]
+    settings = ctx.settings
+    inst_ids, features, columns = load_vectors(target_alts, ctx)
+    n_rows = len(inst_ids)
+    ## Positional index of the instance ids
+    positions = pd.Index(inst_ids)
+
+    ### Clustering step ###
+    ## Determine what needs to be done based on number of sentences and settings
+    use_clustering = n_rows >= (ctx.min_sense_size * 2) + 25
+    use_subset = n_rows > settings.subset_num
+    if use_clustering:
+        record_time('start')
+        if use_subset:
+            subset_rows = subset_positions(positions, ctx.cluster_subset.get(target), settings)
+        else:
+            subset_rows = np.arange(n_rows)
+        cluster_subset = pd.DataFrame(dense_rows(features, subset_rows), 
+                                      index=inst_ids[subset_rows], columns=columns)
+        
+        sense_clusters, cluster_centers = cluster_predictions(
+            cluster_subset, target_alts, settings, ctx.min_sense_size,
+            ctx.plot_clusters, ctx.print_clusters, f'{ctx.output_path}/clusters')
+        record_time('end')
+    else:
+        ## We don't cluster a target that is too small
+        sense_clusters = {0 : list(inst_ids)}
+        pred_vectors = pd.DataFrame(dense_rows(features, slice(None)), index=inst_ids)
+        cluster_centers = get_cluster_centers(pred_vectors, 1, sense_clusters)   
+
+    if sense_clusters == None:
+        return None, []
+
+    log = []
+    log.append('====================================\n')
+    log.append(f'{target.capitalize()} : {n_rows} rows')
+    if len(target_alts) > 1:
+        log.append(f'Alt form: {target_alts[1]}')
+    if not use_clustering:
+        ## We don't want to cluster a target that is too small
+        log.append('\tSkipping WSI; not enough rows\n')
+
+    print('\n\tCluster results')
+    log.append('\n\tCluster results')
+    for sense, cluster in sense_clusters.items():
+        log.append(f'\t{sense} : {len(cluster)}')
+        print(f'\t{sense} : {len(cluster)}')
+
+    ## Cluster the remaining 
+    if use_subset:
+        other_rows = np.ones(n_rows, dtype=bool)
+        other_rows[subset_rows] = False
+        other_rows = np.flatnonzero(other_rows)
+        other_labels = map_other_instances(
+            features, other_rows, cluster_centers, 
+            settings.assign_chunk_rows, settings.assign_workers)
+        for sense in sense_clusters.keys():
+            sense_clusters[sense].extend(inst_ids[other_rows[other_labels == sense]])
+
+        print('\n\tFinal clusters with all rows')
+        log.append('\n\tFull clusters')
+        for sense, cluster in sense_clusters.items():
+            log.append(f'\t{sense} : {len(cluster)}')
+            print(f'\t{sense} : {len(cluster)}')
+
+    cluster_data = get_cluster_data(sense_clusters, target_subset)
+
+    ## Sense label of every row
+    labels = np.zeros(n_rows, dtype=np.int64)
+    for sense, cluster in sense_clusters.items():
+        labels[positions.get_indexer(cluster)] = sense
+
+    ## Save information
+    best_sentences = find_best_sents(inst_ids, features, labels, cluster_centers, 
+                                     list(sense_clusters.keys()), settings.assign_chunk_rows)
+    save_results( ctx.dataset_desc, target, target_subset,
+                  sense_clusters, best_sentences, n_rows, ctx.output_path)
+
+    center_path = f'{ctx.output_path}/clusters/{target}.csv'
+    if not ctx.embed_sents:
+        columns = [ctx.vocab[i] for i in columns]
+    centers = pd.DataFrame(cluster_centers, columns=columns)
+    centers.to_csv(center_path)
+
+    return cluster_data, log
+
+def subset_positions(positions, subset_ids, settings):
+    ## Rows of the subset drawn before predicting
+    ## Falls back to a seeded sample if the target wasn't in it
+    if subset_ids is not None:
+        subset_rows = positions.get_indexer(subset_ids)
+        subset_rows = subset_rows[subset_rows >= 0]
+        if len(subset_rows) != settings.subset_num:
+            raise ValueError(f'{len(subset_rows)} of the saved clustering subset found, '
+                             f'not {settings.subset_num}; the target data has changed '
+                             'since it was drawn, so delete cluster_subset.pkl to draw a new one')
+        return np.sort(subset_rows)
+
+    rng = np.random.default_rng(settings.random_seed)
+    return np.sort(rng.choice(len(positions), settings.subset_num, replace=False))
+
+#### Parallel clustering ####
+## Workers share the target data instead of it being sent per target
+def _cluster_job(job):
+    n, n_targets, target_alts = job
+    target_data, groups, ctx = shared_data()
+    print(f'\n{n+1} / {n_targets} : {" ".join(target_alts)}')
+    return cluster_target(target_alts, target_rows(target_data, groups, target_alts[0]), ctx)
+
 def make_clusters(
     target_data: pd.DataFrame,
     targets: List[str],
@@ -64,99 +216,60 @@ def make_clusters(
     plot_clusters: bool = False,
     print_clusters: bool = False
     ):
-
     settings, logging_file, all_sense_data = prep_io(
         targets, output_path, plot_clusters, print_clusters, 
         resume_clustering, dataset_desc)
 
+    vocab, lemma_ids, vocab_filter = None, None, None
+    if not embed_sents:
+        vocab, lemma_ids = prediction_columns(*load_vocab(output_path), settings)
+        vocab_filter = get_vocab_filter(vocab, settings.language)
+
+    ## Group rows by target once instead of searching the full data for every target
+    groups = group_by_target(target_data)
+
+    ## Same subset the predictions were made for, if they were made with it
+    ## and it was drawn with the current subset settings
+    cluster_subset = load_cluster_subset(output_path, settings)
+    if cluster_subset is None:
+        inst_ids = target_data.index.to_numpy()
+        subset_rows = sample_cluster_subset(
+            target_data, groups, settings.subset_num, settings.random_seed, settings.stratify_by)
+        cluster_subset = {target: inst_ids[rows] for target, rows in subset_rows.items()}
+        save_cluster_subset(cluster_subset, output_path, settings)
+
+    ctx = ClusterContext(
+        settings, dataset_desc, min_sense_size, output_path, embed_sents,
+        plot_clusters, print_clusters, vocab, lemma_ids, vocab_filter, cluster_subset)
+
+    ## Targets are independent, so they can be clustered in worker processes
+    ## Results come back in target order, so the log and labels match a serial run
+    jobs = [(n, len(targets), target_alts) for n, target_alts in enumerate(sorted(targets))]
     sense_data = []
-    for n, target_alts in enumerate(sorted(targets)):
-        # break
-        target = target_alts[0]
-        print(f'\n{n+1} / {len(targets)} : {" ".join(target_alts)}')
-
-        ### Get vectors
-        if embed_sents:
-            with open(f'{output_path}/vectors/{target}.pkl', 'rb') as vp:
-                pred_vectors = pickle.load(vp)
-                pred_vectors = pd.DataFrame.from_dict(pred_vectors).T
-        else:
-            pred_vectors = pd.read_pickle(f'{output_path}/predictions/{target}.pkl')
-            # print(f'\tPredictions loaded')
-            subset_term_ids = trim_predictions(pred_vectors, target_alts, settings.language)
-            pred_vectors = pred_vectors[subset_term_ids]
-
-        ### Clustering step ###
-        ## Determine what needs to be done based on number of sentences and settings
-        use_clustering = len(pred_vectors) >= (min_sense_size * 2) + 25
-        use_subset = len(pred_vectors) > settings.subset_num
-        if use_clustering:
-            record_time('start')
-            if use_subset:
-                cluster_subset = pred_vectors.sample(settings.subset_num)
-            else:
-                cluster_subset = pred_vectors
-            
-            sense_clusters, cluster_centers = cluster_predictions(
-                cluster_subset, target_alts, settings, min_sense_size,
-                plot_clusters, print_clusters, f'{output_path}/clusters')
-            record_time('end')
-        else:
-            ## We don't cluster a target that is too small
-            sense_clusters = {0 : list(pred_vectors.index)}
-            cluster_centers = get_cluster_centers(pred_vectors, 1, sense_clusters)   
-
-        if sense_clusters == None:
-            continue
-
-        with open(logging_file, 'a') as flog:
-            print('====================================\n', file=flog)
-            print(f'{target.capitalize()} : {len(pred_vectors)} rows', file=flog)
-            if len(target_alts) > 1:
-                print(f'Alt form: {target_alts[1]}', file=flog)
-            if not use_clustering:
-                ## We don't want to cluster a target that is too small
-                print('\tSkipping WSI; not enough rows\n', file=flog)
-
-            print('\n\tCluster results')
-            print('\n\tCluster results', file=flog)
-            for sense, cluster in sense_clusters.items():
-                print(f'\t{sense} : {len(cluster)}', file=flog)
-                print(f'\t{sense} : {len(cluster)}')
-
-            ## Cluster the remaining 
-            if use_subset:
-                other_preds = pred_vectors.drop(index=cluster_subset.index)
-                sense_clusters = map_other_instances(other_preds, cluster_centers, sense_clusters)
-
-                print('\n\tFinal clusters with all rows')
-                print('\n\tFull clusters', file=flog)
-                for sense, cluster in sense_clusters.items():
-                    print(f'\t{sense} : {len(cluster)}', file=flog)
-                    print(f'\t{sense} : {len(cluster)}')
-
-        sense_data.append(get_cluster_data(sense_clusters, target_data))
-
-        ## Save information
-        best_sentences = find_best_sents(target_data, pred_vectors, cluster_centers, sense_clusters)
-        save_results( dataset_desc, target, 
-                      sense_clusters, best_sentences, len(pred_vectors), output_path)
-
-        center_path = f'{output_path}/clusters/{target}.csv'
-        centers = pd.DataFrame(cluster_centers, columns=pred_vectors.columns)
-        centers.to_csv(center_path)
+    with fork_pool(settings.cluster_workers, (target_data, groups, ctx)) as pool:
+        results = map(_cluster_job, jobs) if pool is None else pool.imap(_cluster_job, jobs)
+        for cluster_data, log in results:
+            if cluster_data is None:
+                continue
+            sense_data.append(cluster_data)
+            with open(logging_file, 'a') as flog:
+                print('\n'.join(log), file=flog)
 
     if len(sense_data) > 0:
         sense_data = pd.concat(sense_data)
         if resume_clustering:
             sense_data = pd.concat([all_sense_data, sense_data])        
         
-        sense_data.to_pickle(f'{output_path}/target_sense_labels.pkl')
+        write_table(sense_data, f'{output_path}/target_sense_labels.parquet')
     else:
         print('Error; nothing was generated')
+
+    ## Plots are made once clustering is done, from the saved projections
+    if plot_clusters:
+        render_plots(f'{output_path}/clusters', settings.plot_workers)
 # %%
 def save_results(
-    dataset_desc, target, sense_clusters,
+    dataset_desc, target, target_data, sense_clusters,
     best_sentences, sentence_count, output_path):
     
     with open(f'{output_path}/summaries/{target}.txt', 'w+') as fout:
@@ -165,11 +278,11 @@ def save_results(
         print(f'{sentence_count} sentences', file=fout)
         print(f'\nUsing data from {dataset_desc}', file=fout)
 
-        for sense, cluster in best_sentences.items():
+        for sense, best_ids in best_sentences.items():
             print(f'\n=================== Sense {sense} ===================', file=fout)
             print(f'{len(sense_clusters[sense])} sentences\n', file=fout)
 
             print('Central most sentences', file=fout)
-            for index, (pre, targ, post) in cluster:
+            for index, (pre, targ, post) in target_data.loc[best_ids].formatted_sent.items():
                 print(f'\t{index}', file=fout)
                 print(f'\t\t{pre} *{targ}* {post}\n', file=fout)
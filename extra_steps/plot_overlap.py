@@ -7,10 +7,10 @@ import glob
 dataset = 'coha'
 
 main_path = f'/data/arrinj/masking_results/{dataset}/all/'
-path = 'target_sense_labels.pkl'
-cluster_data = pd.read_pickle(main_path + path)
+path = 'target_sense_labels.parquet'
+cluster_data = pd.read_parquet(main_path + path)
 
-sent_path = '_sense_sentences.pkl'
+sent_path = '_sense_sentences.parquet'
 corpora_paths = glob.glob(
   main_path+'/*'+sent_path)
 
@@ -22,7 +22,7 @@ for corpus_path in sorted(corpora_paths):
     len(main_path):-len(sent_path)]
   corpora.append(corpus)
   print(f'\t{corpus} data')
-  sents = pd.read_pickle(corpus_path)
+  sents = pd.read_parquet(corpus_path)
   sents['corpus'] = corpus
   all_sents.append(sents)
 
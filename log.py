@@ -12,9 +12,11 @@ def convert_to_local(t):
 
     return datetime.strftime(t, '%H:%M')
 
+def format_time(desc, t):
+    return f'\t  {desc.capitalize()} time : {convert_to_local(t)}'
+
 def record_time(desc):
-    t = convert_to_local(time.time())
-    t_str = f'\t  {desc.capitalize()} time : {t}'
+    t_str = format_time(desc, time.time())
     print(t_str)
     
     return t_str
@@ -1,14 +1,56 @@
-from wsi.lm_bert import LMBert
+from wsi.lm_bert import LMBert, load_vocab_tables
 from wsi.WSISettings import DEFAULT_PARAMS, WSISettings
-from log import record_time
+from wsi.predictions import save_predictions, load_predictions, merge_predictions, save_vocab
+from wsi.precision_check import check_mixed_precision
+from process_data import (group_by_target, target_rows, sample_cluster_subset, 
+                          save_cluster_subset, load_cluster_subset)
+from wsi.workers import fork_pool, shared_data
+from log import record_time, format_time
+from collections import defaultdict
 from typing import List
 from pathlib import Path
+import multiprocessing
 import pandas as pd
+import numpy as np
 from glob import glob
 import pickle
+import time
+import os
 
 ## Main file for MLM prediction, called from run_wsi_config
 
+def predict_target(lm, segments, target_alts, embed_sents, save_path):
+    ## Predicts (or embeds) one target, or one chunk of a target, and saves it
+    ## segments are (rows, settings) pairs that are saved together
+    start = time.time()
+    if embed_sents:
+        vectors = {}
+        for data_subset, _ in segments:
+            vectors.update(lm.get_embedded_sents(data_subset, target_alts[-1]))
+        end = time.time()
+
+        with open(save_path, 'wb') as vp:
+            pickle.dump(vectors, vp, protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        predictions = merge_predictions([
+            lm.predict_sent_substitute_representatives(
+                data_subset, settings, target_alts[-1], target_alts)
+            for data_subset, settings in segments])
+        end = time.time()
+
+        save_predictions(predictions, save_path)
+    return start, end
+
+def log_target(logging_file, target_alts, num_rows, start, end):
+    with open(logging_file, 'a') as flog:
+        print('====================================\n', file=flog)
+        print(f'{target_alts[0].capitalize()} : {num_rows} rows', file=flog)
+        if len(target_alts) > 1:
+            print(f'Alt form: {target_alts[1]}', file=flog)
+
+        print('\n' + format_time('start', start), file=flog)
+        print(format_time('end', end) + '\n', file=flog)
+
 def make_predictions(
     target_data: pd.DataFrame,
     targets: List[str],
@@ -21,9 +63,6 @@ def make_predictions(
     settings = DEFAULT_PARAMS._asdict()
     settings = WSISettings(**settings)
 
-    ## Load BERT model
-    lm = LMBert(settings)
-
     if embed_sents:
         Path(f'{output_path}/vectors').mkdir(parents=True, exist_ok=True)
     else:
@@ -37,7 +76,7 @@ def make_predictions(
             # print(f'\n{len(target_data):,} rows loaded', file=flog)
             print(f'{len(targets)} targets loaded\n', file=flog)
     else:
-        already_predicted = glob(f'{output_path}/predictions/*.pkl')
+        already_predicted = glob(f'{output_path}/predictions/*.npz')
         skip_targets = [path.split('/')[-1][:-4] for path in already_predicted]
         print(f'{len(skip_targets)} targets already predicted')
 
@@ -51,34 +90,197 @@ def make_predictions(
             targets.remove(target)
         print(f'{len(targets)} targets going to be clustered')
 
+    ## Group rows by target once instead of scanning the data for every target
+    groups = group_by_target(target_data)
+    subset = prepare_subset(target_data, groups, settings, output_path, resume_predicting)
+
+    ## Multiple devices split the targets between worker processes
+    if settings.cuda_devices is not None and len(settings.cuda_devices) > 1:
+        predict_sharded(target_data, groups, subset, targets, settings, output_path,
+                        logging_file, embed_sents)
+        return
+
+    ## Load BERT model
+    lm = LMBert(settings)
+    prepare_corpus(lm, target_data, output_path, embed_sents)
+    log_lines(logging_file, precision_check(lm, target_data, groups, targets, settings, embed_sents))
+
     for n, target_alts in enumerate(sorted(targets)):
         # break
         target = target_alts[0]
         print(f'\n{n+1} / {len(targets)} : {" ".join(target_alts)}')
 
-        data_subset = target_data[target_data.target == target]
-        num_rows = len(data_subset)
+        segments = prediction_segments(
+            target_data, groups.get(target, np.zeros(0, dtype=np.int64)), 
+            subset.get(target), settings, embed_sents)
+        segments = [(target_data.iloc[rows], seg_settings) for rows, seg_settings in segments]
+        num_rows = sum(len(data_subset) for data_subset, _ in segments)
+
+        print(f'\tPredicting for {num_rows} rows...')
+        record_time('start')
+        start, end = predict_target(
+            lm, segments, target_alts, embed_sents,
+            target_save_path(output_path, target, embed_sents))
+        record_time('end')
+        log_target(logging_file, target_alts, num_rows, start, end)
+        print('\tVectors saved' if embed_sents else '\tPredictions saved')
+
+def prepare_subset(target_data, groups, settings, output_path, resume_predicting):
+    ## The rows each target is clustered on, drawn before predicting
+    ## A resumed run keeps the subset it started with, if the subset settings are unchanged
+    subset = load_cluster_subset(output_path, settings) if resume_predicting else None
+    if subset is None:
+        inst_ids = target_data.word_idx.to_numpy()
+        positions = sample_cluster_subset(
+            target_data, groups, settings.subset_num, settings.random_seed, settings.stratify_by)
+        subset = {target: inst_ids[rows] for target, rows in positions.items()}
+        save_cluster_subset(subset, output_path, settings)
+    return subset
+
+def prediction_segments(target_data, positions, subset_ids, settings, embed_sents):
+    ## Rows outside of the clustering subset are only assigned to their closest sense,
+    ## so they can be predicted with fewer top terms
+    if subset_ids is None or embed_sents or settings.other_prediction_cutoff is None:
+        return [(positions, settings)]
+
+    in_subset = np.isin(target_data.word_idx.to_numpy()[positions], subset_ids)
+    other_settings = settings._replace(prediction_cutoff=settings.other_prediction_cutoff)
+    return [(positions[in_subset], settings), (positions[~in_subset], other_settings)]
+
+def prepare_corpus(lm, target_data, output_path, embed_sents):
+    if not embed_sents:
+        save_vocab(lm.original_vocab, lm.lemmatized_vocab, output_path)
+
+    ## Tokenize every instance up front; cached for later runs on this corpus
+    lm.tokenize_contexts(target_data, f'{output_path}/tokenized_contexts.npz')
+
+def precision_check(lm, target_data, groups, targets, settings, embed_sents):
+    ## Compares mixed precision to fp32 on the biggest target before using it
+    if lm.autocast_dtype is None or embed_sents or settings.precision_check_size <= 0 or not targets:
+        return []
 
+    target_alts = max(targets, key=lambda alts: len(groups.get(alts[0], [])))
+    data_subset = target_rows(target_data, groups, target_alts[0])
+    report = check_mixed_precision(lm, data_subset, target_alts, settings)
+    print('\n'.join(report))
+    return report
+
+def log_lines(logging_file, lines):
+    if lines:
         with open(logging_file, 'a') as flog:
-            print('====================================\n', file=flog)
-            print(f'{target.capitalize()} : {num_rows} rows', file=flog)
-            if len(target_alts) > 1:
-                print(f'Alt form: {target_alts[1]}', file=flog)
-
-            print(f'\tPredicting for {num_rows} rows...')
-            print('\n' + record_time('start'), file=flog)
-            if embed_sents:
-                vectors = lm.embed_sents(data_subset, target_alts[-1])
-                print(record_time('end') + '\n', file=flog)
-
-                with open(f'{output_path}/vectors/{target}.pkl', 'wb') as vp:
-                    pickle.dump(vectors, vp, protocol=pickle.HIGHEST_PROTOCOL)
-                print(f'\tVectors saved')
-
-            else:
-                predictions = lm.predict_sent_substitute_representatives(
-                    data_subset, settings, target_alts[-1])
-                print(record_time('end') + '\n', file=flog)
-                
-                predictions.to_pickle(f'{output_path}/predictions/{target}.pkl')
-                print(f'\tPredictions saved')
+            print('\n'.join(lines) + '\n', file=flog)
+
+def target_save_path(output_path, target, embed_sents, part=None):
+    folder = 'vectors' if embed_sents else 'predictions'
+    ext = 'pkl' if embed_sents else 'npz'
+    if part is None:
+        return f'{output_path}/{folder}/{target}.{ext}'
+    return f'{output_path}/{folder}/parts/{target}.part{part}.{ext}'
+
+#### Multi-device prediction ####
+## Each worker process holds its own LMBert on one device
+## The target data is shared with the workers instead of being sent per job
+_worker_lm = None
+
+def _init_worker(devices, settings, vocab_tables):
+    global _worker_lm
+    _worker_lm = LMBert(settings._replace(cuda_device=devices.get()), vocab_tables)
+
+def _prepare_worker(groups, targets, settings, output_path, embed_sents):
+    prepare_corpus(_worker_lm, shared_data(), output_path, embed_sents)
+    return precision_check(_worker_lm, shared_data(), groups, targets, settings, embed_sents)
+
+def _predict_chunk(job):
+    target_alts, part, positions, settings, embed_sents, output_path = job
+    data_subset = shared_data().iloc[positions]
+    ## Contexts come from the cache made by _prepare_worker, loaded on a worker's first job
+    ## Later jobs only look their rows up in the loaded index
+    if _worker_lm.contexts is None:
+        _worker_lm.tokenize_contexts(data_subset, f'{output_path}/tokenized_contexts.npz')
+
+    save_path = target_save_path(output_path, target_alts[0], embed_sents, part)
+    start, end = predict_target(
+        _worker_lm, [(data_subset, settings)], target_alts, embed_sents, save_path)
+    return target_alts, part, len(data_subset), start, end
+
+def merge_parts(output_path, target, n_parts, embed_sents):
+    save_path = target_save_path(output_path, target, embed_sents)
+    part_paths = [target_save_path(output_path, target, embed_sents, part)
+                  for part in range(n_parts)]
+    if n_parts == 1:
+        os.replace(part_paths[0], save_path)
+        return
+
+    if embed_sents:
+        vectors = {}
+        for path in part_paths:
+            with open(path, 'rb') as vp:
+                vectors.update(pickle.load(vp))
+        with open(save_path, 'wb') as vp:
+            pickle.dump(vectors, vp, protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        predictions = merge_predictions([load_predictions(path) for path in part_paths])
+        save_predictions(predictions, save_path)
+
+    for path in part_paths:
+        os.remove(path)
+
+def predict_sharded(target_data, groups, subset, targets, settings, output_path, logging_file, embed_sents):
+    devices = settings.cuda_devices
+    folder = 'vectors' if embed_sents else 'predictions'
+    Path(f'{output_path}/{folder}/parts').mkdir(parents=True, exist_ok=True)
+
+    ## Targets bigger than max_chunk_rows are split into chunks
+    ## Biggest jobs go first so the devices finish close together
+    jobs = []
+    n_parts = {}
+    for target_alts in sorted(targets):
+        positions = groups.get(target_alts[0], [])
+        if len(positions) == 0:
+            print(f'No rows for {target_alts[0]}, skipping')
+            continue
+
+        segments = prediction_segments(
+            target_data, positions, subset.get(target_alts[0]), settings, embed_sents)
+        n_parts[target_alts[0]] = 0
+        for segment, seg_settings in segments:
+            for chunk_start in range(0, len(segment), settings.max_chunk_rows):
+                chunk = segment[chunk_start:chunk_start + settings.max_chunk_rows]
+                jobs.append((target_alts, n_parts[target_alts[0]], chunk, 
+                             seg_settings, embed_sents, output_path))
+                n_parts[target_alts[0]] += 1
+    jobs.sort(key=lambda job: len(job[2]), reverse=True)
+    print(f'{len(jobs)} jobs for {len(n_parts)} targets over devices {devices}')
+
+    ## The parent never initializes CUDA, so forked workers can each set up their own device
+    device_queue = multiprocessing.get_context('fork').Queue()
+    for device in devices:
+        device_queue.put(device)
+
+    ## The vocab tables are built here, since lemmatizing starts processes of its own
+    vocab_tables = load_vocab_tables(settings)
+
+    finished = defaultdict(list)
+    with fork_pool(len(devices), target_data, _init_worker, 
+                   (device_queue, settings, vocab_tables)) as pool:
+        ## One worker saves the vocab and the tokenized contexts for the others
+        log_lines(logging_file, pool.apply(
+            _prepare_worker, (groups, targets, settings, output_path, embed_sents)))
+
+        for target_alts, part, num_rows, start, end in pool.imap_unordered(_predict_chunk, jobs):
+            target = target_alts[0]
+            finished[target].append((num_rows, start, end))
+            print(f'\t{target} part {part + 1} / {n_parts[target]} done ({num_rows} rows)')
+
+            if len(finished[target]) == n_parts[target]:
+                merge_parts(output_path, target, n_parts[target], embed_sents)
+
+    ## Log the same way as a single device run, in target order
+    for target_alts in sorted(targets):
+        parts = finished[target_alts[0]]
+        if not parts:
+            continue
+        log_target(logging_file, target_alts,
+                   sum(num_rows for num_rows, _, _ in parts),
+                   min(start for _, start, _ in parts),
+                   max(end for _, _, end in parts))
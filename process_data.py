@@ -1,4 +1,9 @@
+from storage import read_table, iter_batches, find_table, count_rows
+from pandas.api.types import union_categoricals
 import pandas as pd
+import numpy as np
+import pickle
+import zlib
 
 # min_count - requires target to show up n times; not worth clustering otherwise
 # min length - requires sentence to be above length k; important for context window
@@ -17,31 +22,145 @@ def filter_target_data(
     all_data = []
     ### Do some initial filtering before combining ###
     for corpus, path in target_paths.items():
-      data = pd.read_pickle(path)
-      print(f'= {len(data):,} rows pulled for {corpus} =')
+      ## Only target rows are read from columnar files, which are counted from their metadata
+      ## Pickles are read whole and filtered after
+      n_rows = count_rows(path)
+      filters = None if targets is None or n_rows is None else [('target', 'in', list(targets))]
+      data = read_table(path, filters=filters)
+      all_data.append(filter_corpus(data, corpus, targets, min_length, occurence_limit, n_rows))
 
-      ## Filter out non-target rows
-      if targets is not None:
-          data = data[data.target.isin(targets)]
-          print(f'\n{len(data):,} target instances after targets selected')
+    return filter_merged(all_data, min_count, subset_num)
 
-      ## Apply minimum length filter
-      len_data = data[data.length >= min_length]
-      ids = len_data.sent_idx.unique()
-      data = data[data.sent_idx.isin(ids)]
-      print(f'{len(data):,} instances after {min_length} length minimum applied')
-      del ids
+## Out of core version of filter_target_data, for corpora that don't fit in memory
+## The first pass streams target, sent_idx and length batch_rows at a time, keeping only
+## each row's (target, sent_idx) pair and per sentence length and count state
+## The second pass streams every column of the surviving rows into a Parquet file at output_file
+## Corpora have to be columnar; pickled ones can be converted with storage.convert_table
+def stream_filter_target_data(
+    target_paths,
+    output_file,
+    targets=None,
+    min_count=50,
+    min_length=25, 
+    occurence_limit=10, 
+    subset_num=100000,
+    batch_rows=1000000
+    ):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    for corpus, path in target_paths.items():
+        if find_table(path).endswith('.pkl'):
+            raise ValueError(f'{corpus} is pickled ({find_table(path)}) and can\'t be streamed; '
+                             'convert it with storage.convert_table first')
+
+    filters = None if targets is None else [('target', 'in', list(targets))]
+    all_pairs = []
+    for corpus, path in target_paths.items():
+        pairs = stream_corpus_pairs(path, corpus, filters, targets, min_length, 
+                                    occurence_limit, batch_rows)
+        all_pairs.append(pairs)
+    kept = filter_merged(all_pairs, min_count, subset_num)
+    del all_pairs
+
+    ## Rows survive if their sentence survived in their corpus and their target has enough rows
+    kept_targets = pa.array(kept.target.cat.categories.astype(str).tolist(), pa.string())
+    writer = None
+    n_rows = 0
+    for corpus, path in target_paths.items():
+        kept_sents = pa.array(kept.sent_idx[kept.corpus == corpus].unique())
+        for batch in iter_batches(path, filters=filters, batch_rows=batch_rows):
+            mask = pc.and_(
+                pc.is_in(batch.column('sent_idx'), value_set=kept_sents),
+                pc.is_in(batch.column('target').cast(pa.string()), value_set=kept_targets))
+            batch = batch.filter(mask)
+            table = pa.Table.from_batches([batch]).append_column(
+                'corpus', pa.array([corpus] * len(batch), pa.string()).dictionary_encode())
+
+            if writer is None:
+                writer = pq.ParquetWriter(output_file, table.schema)
+            elif not table.schema.equals(writer.schema, check_metadata=False):
+                ## Corpora stored differently are written with the first one's types
+                table = table.cast(writer.schema)
+            writer.write_table(table)
+            n_rows += len(batch)
+    if writer is not None:
+        writer.close()
+
+    print(f'{n_rows:,} rows written to {output_file}')
+    return output_file
+
+def stream_corpus_pairs(path, corpus, filters, targets, min_length, occurence_limit, batch_rows):
+    ## The (target, sent_idx) pairs of a corpus that pass its length and occurence filters
+    pair_targets, pair_sents, sent_states = [], [], []
+    for batch in iter_batches(path, ['target', 'sent_idx', 'length'], filters, batch_rows):
+        sent_idx = batch.column('sent_idx').to_numpy(zero_copy_only=False)
+        pair_targets.append(pd.Categorical(batch.column('target').to_pandas()))
+        pair_sents.append(sent_idx)
+
+        ## Whether a sentence has a long enough row, and how many target rows it has
+        state = pd.DataFrame({
+            'long': batch.column('length').to_numpy(zero_copy_only=False) >= min_length,
+            'count': 1}, index=sent_idx)
+        sent_states.append(state.groupby(level=0).agg({'long': 'max', 'count': 'sum'}))
+
+    pairs = pd.DataFrame({
+        'target': union_categoricals(pair_targets) if pair_targets else pd.Categorical([]),
+        'sent_idx': np.concatenate(pair_sents) if pair_sents else np.zeros(0, dtype=np.int64)})
+    del pair_targets, pair_sents
+    print(f'= {count_rows(path):,} rows pulled for {corpus} =')
+    if targets is not None:
+        print(f'\n{len(pairs):,} target instances after targets selected')
+
+    if sent_states:
+        sent_state = pd.concat(sent_states).groupby(level=0).agg({'long': 'max', 'count': 'sum'})
+    else:
+        sent_state = pd.DataFrame({'long': [], 'count': []})
+    del sent_states
 
-      ## Apply occurence limit filter
-      index_vc = data.sent_idx.value_counts()
-      ids = index_vc[index_vc <= occurence_limit].index
-      data = data[data.sent_idx.isin(ids)]
-      print(f'{len(data):,} after {occurence_limit} occurence limit applied\n\n')
+    ## Apply minimum length filter
+    long_sents = sent_state[sent_state.long]
+    print(f'{long_sents["count"].sum():,} instances after {min_length} length minimum applied')
 
-      all_data.append(data)
+    ## Apply occurence limit filter
+    kept_sents = long_sents.index[long_sents['count'] <= occurence_limit]
+    pairs = pairs[pairs.sent_idx.isin(kept_sents)]
+    print(f'{len(pairs):,} after {occurence_limit} occurence limit applied\n\n')
 
+    ## Kept so clustering can stratify by corpus
+    return pairs.assign(corpus=corpus)
+
+def filter_corpus(data, corpus, targets, min_length, occurence_limit, n_rows=None):
+    ## n_rows is the corpus' size when data was filtered to the targets as it was read
+    print(f'= {len(data) if n_rows is None else n_rows:,} rows pulled for {corpus} =')
+
+    ## Filter out non-target rows
+    if targets is not None:
+        data = data[data.target.isin(targets)]
+        print(f'\n{len(data):,} target instances after targets selected')
+
+    ## Apply minimum length filter
+    len_data = data[data.length >= min_length]
+    ids = len_data.sent_idx.unique()
+    data = data[data.sent_idx.isin(ids)]
+    print(f'{len(data):,} instances after {min_length} length minimum applied')
+    del ids
+
+    ## Apply occurence limit filter
+    index_vc = data.sent_idx.value_counts()
+    ids = index_vc[index_vc <= occurence_limit].index
+    data = data[data.sent_idx.isin(ids)]
+    print(f'{len(data):,} after {occurence_limit} occurence limit applied\n\n')
+
+    ## Kept so clustering can stratify by corpus
+    return data.assign(corpus=corpus)
+
+def filter_merged(all_data, min_count, subset_num):
     ## Convert list to merged data frame
     data = pd.concat(all_data)
+    data['target'] = data.target.astype('category').cat.remove_unused_categories()
+    data['corpus'] = data.corpus.astype('category')
     del all_data
     print(f'{len(data):,} target instances pulled')
 
@@ -50,24 +169,34 @@ def filter_target_data(
 
     ## TODO: Just remove this?
     ## Apply general subset to data
+    ## Each target keeps the subset_num sentences with the fewest targets in them,
+    ## going from the most to the least frequent target
+    ## Sentence counts don't change as whole sentences are dropped, so they're found once
     vc = data.target.value_counts()
     too_many = vc[vc > subset_num]
-    for target in too_many.index:
-        # TODO: maybe this doesnt work bc of multiindex
-        index_vc = data.sent_idx.value_counts()
-        ids = data[data.target == target].sent_idx
-        
-        # This selects from the bottom up (so smallest to largest)
-        bigger_rows = index_vc[index_vc.index.isin(ids)][:-subset_num]
-        
-        print(f'\t{len(bigger_rows):,} rows being removed for {target}')
-        data = data[~data.sent_idx.isin(bigger_rows.index)]
+    if len(too_many) > 0:
+        sent_codes, _ = pd.factorize(data.sent_idx)
+        sent_counts = np.bincount(sent_codes)
+        dropped = np.zeros(len(sent_counts), dtype=bool)
+        groups = group_by_target(data)
+        for target in too_many.index:
+            ## The target's remaining sentences, most targets first (ties in order of appearance)
+            sents = np.unique(sent_codes[groups[target]])
+            sents = sents[~dropped[sents]]
+            sents = sents[np.argsort(-sent_counts[sents], kind='stable')]
+
+            bigger_rows = sents[:max(len(sents) - subset_num, 0)]
+            print(f'\t{len(bigger_rows):,} rows being removed for {target}')
+            dropped[bigger_rows] = True
+        data = data[~dropped[sent_codes]]
     print(f'{len(data):,} after {subset_num} max applied')
 
     ## Apply minimum count filter
+    data['target'] = data.target.cat.remove_unused_categories()
     vc = data.target.value_counts()
     targets = vc[vc >= min_count].index
     data = data[data.target.isin(targets)]
+    data['target'] = data.target.cat.remove_unused_categories()
     print(f'{len(data):,} after insufficient targets removed')
     
     new_vc = len(vc)
@@ -76,3 +205,80 @@ def filter_target_data(
 
     return data
 
+
+## Row positions of every target, found with one sort over a categorical target column
+## Each stage can then take a cheap per target slice with data.iloc[positions]
+def group_by_target(data):
+    targets = data.target.astype('category')
+    codes = targets.cat.codes.to_numpy()
+
+    ## Stable, so each target's positions stay in row order
+    order = np.argsort(codes, kind='stable')
+    offsets = np.zeros(len(targets.cat.categories) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes[codes >= 0], minlength=len(targets.cat.categories)), 
+              out=offsets[1:])
+
+    ## Missing targets (code -1) sort first, so skip past them
+    order = order[(codes < 0).sum():]
+    return {target: order[offsets[i]:offsets[i + 1]]
+            for i, target in enumerate(targets.cat.categories)}
+
+def target_rows(data, groups, target):
+    return data.iloc[groups.get(target, np.zeros(0, dtype=np.int64))]
+
+## Seeded sample of the rows each target is clustered on, drawn before predicting
+## Only targets with more than subset_num rows are sampled
+## Each target gets its own generator, so its sample doesn't depend on the other targets
+def sample_cluster_subset(data, groups, subset_num, seed, stratify_by=None):
+    strata = None if stratify_by is None else data[stratify_by].to_numpy()
+    subset = {}
+    for target, positions in groups.items():
+        if len(positions) <= subset_num:
+            continue
+
+        rng = np.random.default_rng([seed, zlib.crc32(target.encode())])
+        if strata is None:
+            sample = rng.choice(positions, subset_num, replace=False)
+        else:
+            sample = stratified_sample(rng, positions, strata[positions], subset_num)
+        subset[target] = np.sort(sample)
+    return subset
+
+def stratified_sample(rng, positions, strata, subset_num):
+    ## Each stratum gets a share of the sample proportional to its size,
+    ## with the rounding left over going to the biggest remainders
+    _, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+    quotas = counts * subset_num / len(positions)
+    sizes = np.floor(quotas).astype(np.int64)
+    leftover = subset_num - sizes.sum()
+    sizes[np.argsort(sizes - quotas, kind='stable')[:leftover]] += 1
+    return np.concatenate([rng.choice(positions[inverse == i], size, replace=False)
+                           for i, size in enumerate(sizes)])
+
+def subset_settings(settings):
+    return {
+        'subset_num': settings.subset_num,
+        'random_seed': settings.random_seed,
+        'stratify_by': settings.stratify_by}
+
+## The subset is saved as instance ids, so prediction and clustering use the same rows
+## The settings it was drawn with are saved alongside, so changing them draws a new one
+def save_cluster_subset(subset, output_path, settings):
+    with open(f'{output_path}/cluster_subset.pkl', 'wb') as fout:
+        pickle.dump({'settings': subset_settings(settings), 'subset': subset}, 
+                    fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_cluster_subset(output_path, settings):
+    ## None if there's no saved subset or it was drawn with other settings
+    try:
+        with open(f'{output_path}/cluster_subset.pkl', 'rb') as fin:
+            saved = pickle.load(fin)
+    except FileNotFoundError:
+        return None
+
+    drawn_with = saved.get('settings') if set(saved) == {'settings', 'subset'} else None
+    if drawn_with != subset_settings(settings):
+        print(f'Saved clustering subset was drawn with {drawn_with}, '
+              f'not {subset_settings(settings)}; drawing a new one')
+        return None
+    return saved['subset']
@@ -1,9 +1,11 @@
 #%%
-from process_data import filter_target_data
+from process_data import filter_target_data, stream_filter_target_data
+from storage import read_table
 from predict_main import make_predictions
 from cluster_main import make_clusters
-from sentence_maker import create_sense_sentences
+from sentence_maker import create_all_sense_sentences
 from dotenv import dotenv_values
+from pathlib import Path
 import json
 
 ### This is the main file for the masking portion
@@ -20,6 +22,8 @@ generate_new_predictions = True
 dataset_name = 'semeval'
 selected_corpus = '2000s'
 embed_sents = False # use BERT embeddings for clustering instead of MLM prediciton vectors
+stream_filter = False # filter corpora too big for memory in batches, through a file in save_path
+sentence_workers = 4 # processes writing the sense sentences of the corpora
 
 ## Get information about corpus and set paths
 def prep_corpus_info(input_path, config, corpus_name):
@@ -78,11 +82,19 @@ for corpus_info in corpora_info:
     # TODO: get alt targets for US / UK
     # og_targets = [
     #     'face_nn','head_nn']
-    target_data = filter_target_data(
-        target_paths, og_targets, 
-        config['min_sense_size'], 
-        config['min_length'], 
-        config['occurence_lim'])
+    if stream_filter:
+        Path(save_path).mkdir(parents=True, exist_ok=True)
+        target_data = read_table(stream_filter_target_data(
+            target_paths, f'{save_path}/target_data.parquet', og_targets, 
+            config['min_sense_size'], 
+            config['min_length'], 
+            config['occurence_lim']))
+    else:
+        target_data = filter_target_data(
+            target_paths, og_targets, 
+            config['min_sense_size'], 
+            config['min_length'], 
+            config['occurence_lim'])
 
     if dataset_name == 'semeval':
         ## original corpus is POS labeled; need to trim off for BERT
@@ -113,10 +125,9 @@ for corpus_info in corpora_info:
     else: 
         corpora = [corpus_name]
 
-    for corpus_name in corpora:
-        subset_path = f"{input_path}/subset/{corpus_name}_indexed"
-        sentence_path = f"{subset_path}_sentences.pkl"
-        create_sense_sentences(sentence_path, save_path, corpus_name)
+    sentence_paths = {corpus_name : f"{input_path}/subset/{corpus_name}_indexed_sentences.pkl"
+                      for corpus_name in corpora}
+    create_all_sense_sentences(sentence_paths, save_path, workers=sentence_workers)
 
 print("Done!")
 # %%
@@ -1,14 +1,21 @@
-from pathlib import Path
+from storage import read_table, write_table
+from wsi.workers import fork_pool, shared_data
+from collections import defaultdict
+import contextlib
 import pandas as pd
-from tqdm import tqdm
+import numpy as np
+import itertools
+import io
 
-def get_sentence_data(sentence_path):
+def get_sentence_data(sentence_path, ids=None):
     if 'csv' in sentence_path:
         sentence_data = pd.read_csv(sentence_path, usecols=['sent_idx', 'word_idx_sent'])
         sentence_data.word_idx_sent = sentence_data.word_idx_sent.apply(eval)
         # sentence_data.set_index('sent_idx', inplace=True) ## maybe this default
-    elif 'pkl' in sentence_path:
-        sentence_data = pd.read_pickle(sentence_path)
+    else:
+        ## Only the sentences with assigned senses are read from columnar files
+        filters = None if ids is None else [('sent_idx', 'in', ids)]
+        sentence_data = read_table(sentence_path, columns=['word_idx_sent'], filters=filters)
     return sentence_data
 
 def process_sentences(sentence_data, target_data, targets, ids):
@@ -23,38 +30,47 @@ def process_sentences(sentence_data, target_data, targets, ids):
         ids = good_ids
     sentence_data = sentence_data.loc[ids]
 
-    sense_sents = []
-    num_bad = 0
-    for sent_id, row in tqdm(sentence_data.iterrows(), total=len(sentence_data)):
-        sent = row['word_idx_sent']
-
-        sense_sent = []
-        add_sent = True
-        for word in sent:
-            target = word.split('.')[0]
-            if '.' not in word:
-                sense_sent.append(word)
-
-            elif target not in targets:
-                sense_sent.append(target)
-
-            elif word in target_data.index:
-                t_row = target_data.loc[word]
-                sense = f'{target}.{t_row.cluster}'
-                sense_sent.append(sense)
-
-            else:
-                print(f'Bad! {sent_id} - {word}')
-                num_bad += 1
-                add_sent = False
-                break
-
-        if add_sent:
-            sense_sents.append([sent_id, sense_sent])
+    ## Every token of every sentence in one array, with the sentence each came from
+    sents = sentence_data.word_idx_sent.tolist()
+    lengths = np.fromiter((len(sent) for sent in sents), dtype=np.int64, count=len(sents))
+    offsets = np.zeros(len(sents) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    words = pd.Series(list(itertools.chain.from_iterable(sents)), dtype=object)
+    sent_rows = np.repeat(np.arange(len(sents)), lengths)
+
+    ## Target instances look like target.id; other words with a '.' are reduced to the part before it
+    prefixes = words.str.split('.', n=1).str[0]
+    has_dot = words.str.contains('.', regex=False).to_numpy(dtype=bool)
+    is_target = has_dot & prefixes.isin(set(targets)).to_numpy()
+    prefixes = prefixes.to_numpy(dtype=object)
+
+    ## One join of the target instances against the sense labels
+    labels = target_data.cluster[~target_data.index.duplicated()]
+    label_rows = labels.index.get_indexer(words[is_target])
+    found = label_rows >= 0
+
+    sense_words = words.to_numpy(dtype=object, copy=True)
+    sense_words[has_dot & ~is_target] = prefixes[has_dot & ~is_target]
+    target_words = np.flatnonzero(is_target)
+    sense_words[target_words[found]] = (
+        prefixes[target_words[found]] + '.' + labels.iloc[label_rows[found]].astype(str).to_numpy())
+
+    ## Sentences with a target instance that has no sense are skipped
+    missing = target_words[~found]
+    bad_rows, first_missing = np.unique(sent_rows[missing], return_index=True)
+    sent_ids = sentence_data.index
+    for row, word in zip(bad_rows, missing[first_missing]):
+        print(f'Bad! {sent_ids[row]} - {words.iloc[word]}')
+    num_bad = len(bad_rows)
+
+    is_good = np.ones(len(sents), dtype=bool)
+    is_good[bad_rows] = False
+    sense_sents = [[sent_ids[row], sense_words[offsets[row]:offsets[row + 1]].tolist()]
+                   for row in np.flatnonzero(is_good)]
 
     print(f'{num_bad:,} sentences were skipped')
 
-    return sense_sents
+    return sense_sents, num_bad
 
 def save_sense_sents(sense_sents, output_path, corpus_name):
     print(f'{len(sense_sents):,} sentences modified with senses')
@@ -62,12 +78,11 @@ def save_sense_sents(sense_sents, output_path, corpus_name):
     sense_data = pd.DataFrame(sense_sents, columns=['sent_idx', 'sense_sent'])
     sense_data.set_index('sent_idx', inplace=True) 
 
-    Path(output_path).mkdir(parents=True, exist_ok=True)
-    sense_data.to_pickle(f'{output_path}/{corpus_name}_sense_sentences.pkl')
+    write_table(sense_data, f'{output_path}/{corpus_name}_sense_sentences.parquet')
 
-def create_sense_sentences(sentence_path, output_path, corpus_name, slice_max=None):
-    target_data = pd.read_pickle(
-        f'{output_path}/target_sense_labels.pkl')
+def load_sense_labels(output_path):
+    target_data = read_table(
+        f'{output_path}/target_sense_labels', columns=['target', 'sent_idx', 'cluster'])
     print(f'{len(target_data):,} targets predicted')
 
     targets = list(target_data.target.unique())
@@ -75,18 +90,60 @@ def create_sense_sentences(sentence_path, output_path, corpus_name, slice_max=No
     
     ids = target_data.sent_idx.unique()
     print(f'{len(ids):,} unique sentences with assigned senses')
+    return target_data, targets, ids
 
+def sentence_jobs(sentence_path, output_path, corpus_name, slice_max=None):
+    ## (sentences to read, where to save, corpus, slice) for a corpus or each of its slices
     if slice_max is None:
-        sentence_data = get_sentence_data(sentence_path)
-        sense_sents = process_sentences(sentence_data, target_data, targets, ids)
-        save_sense_sents(sense_sents, output_path, corpus_name)
+        return [(sentence_path, output_path, corpus_name, None)]
+    return [(f'{sentence_path}/slice_{slice_num}/target_sentences.pkl', 
+             f'{output_path}/slice_{slice_num}', corpus_name, slice_num)
+            for slice_num in range(0, slice_max)]
 
-    else:
-        for slice_num in range(0, slice_max):
-            s_path = f'{sentence_path}/slice_{slice_num}/target_sentences.pkl'
-            sentence_data = get_sentence_data(s_path)
-
-            o_path = f'{output_path}/slice_{slice_num}'
-            print(f'\n==== Slice {slice_num} ====')
-            sense_sents = process_sentences(sentence_data, target_data, targets, ids)
-            save_sense_sents(sense_sents, o_path, corpus_name)
+def write_sense_sents(job, labels):
+    sentence_path, o_path, corpus_name, _ = job
+    target_data, targets, ids = labels
+
+    sentence_data = get_sentence_data(sentence_path, ids)
+    sense_sents, num_bad = process_sentences(sentence_data, target_data, targets, ids)
+    save_sense_sents(sense_sents, o_path, corpus_name)
+    return len(sense_sents), num_bad
+
+def create_sense_sentences(sentence_path, output_path, corpus_name, slice_max=None):
+    labels = load_sense_labels(output_path)
+    for job in sentence_jobs(sentence_path, output_path, corpus_name, slice_max):
+        if job[3] is not None:
+            print(f'\n==== Slice {job[3]} ====')
+        write_sense_sents(job, labels)
+
+#### Every corpus at once ####
+## The labels are loaded once and shared read-only with the workers
+def _sense_sents_job(job):
+    ## Each job's output is kept together so it can be shown per corpus
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        n_sents, num_bad = write_sense_sents(job, shared_data())
+    return job, n_sents, num_bad, log.getvalue()
+
+def create_all_sense_sentences(sentence_paths, output_path, slice_max=None, workers=1):
+    ## sentence_paths is corpus name -> sentence path, written for every corpus (and slice) in parallel
+    sense_labels = load_sense_labels(output_path)
+
+    jobs = [job for corpus_name, sentence_path in sentence_paths.items()
+            for job in sentence_jobs(sentence_path, output_path, corpus_name, slice_max)]
+    print(f'{len(jobs)} sentence sets over {workers} workers')
+
+    skipped = defaultdict(int)
+    written = defaultdict(int)
+    with fork_pool(min(workers, len(jobs)), sense_labels) as pool:
+        run = map if pool is None else pool.imap
+        for (_, _, corpus_name, slice_num), n_sents, num_bad, log in run(_sense_sents_job, jobs):
+            desc = corpus_name if slice_num is None else f'{corpus_name} slice {slice_num}'
+            print(f'\n==== {desc} ====')
+            print(log, end='')
+            written[corpus_name] += n_sents
+            skipped[corpus_name] += num_bad
+
+    print('\n==== Sense sentences ====')
+    for corpus_name in sentence_paths:
+        print(f'\t{corpus_name} : {written[corpus_name]:,} written, {skipped[corpus_name]:,} skipped')
@@ -0,0 +1,156 @@
+from pathlib import Path
+import pandas as pd
+import numpy as np
+
+## Tables (corpus data, sense labels, sense sentences) are stored as Parquet or Feather,
+## so each stage only reads the columns and rows it needs
+## Paths are given with any extension; the first of these found is read,
+## so older pickled results still load
+TABLE_FORMATS = ['parquet', 'feather', 'pkl']
+
+def table_stem(path):
+    path = str(path)
+    for ext in TABLE_FORMATS:
+        if path.endswith(f'.{ext}'):
+            return path[:-len(ext) - 1]
+    return path
+
+def find_table(path):
+    stem = table_stem(path)
+    for ext in TABLE_FORMATS:
+        if Path(f'{stem}.{ext}').exists():
+            return f'{stem}.{ext}'
+    raise FileNotFoundError(f'No table found for {stem} ({", ".join(TABLE_FORMATS)})')
+
+## filters are (column, op, value) tuples, with op one of 'in', '==', '!=', '<', '<=', '>', '>='
+## They're pushed down to the file when reading Parquet or Feather
+def filter_expression(filters):
+    import pyarrow.dataset as ds
+
+    expression = None
+    for column, op, value in filters:
+        field = ds.field(column)
+        if op == 'in':
+            condition = field.isin(list(value))
+        else:
+            condition = {
+                '==': field == value, '!=': field != value,
+                '<': field < value, '<=': field <= value,
+                '>': field > value, '>=': field >= value}[op]
+        expression = condition if expression is None else expression & condition
+    return expression
+
+def filter_mask(data, filters):
+    ## Same filters for pickled tables; index levels can be filtered like columns
+    mask = np.ones(len(data), dtype=bool)
+    for column, op, value in filters:
+        if column in data.columns:
+            values = data[column]
+        elif column in data.index.names or data.index.nlevels > 1:
+            values = pd.Series(data.index.get_level_values(column), index=data.index)
+        else:
+            ## A single unnamed (or differently named) index is taken to be the column
+            values = pd.Series(data.index, index=data.index)
+
+        if op == 'in':
+            mask &= values.isin(list(value)).to_numpy()
+        else:
+            mask &= {
+                '==': values == value, '!=': values != value,
+                '<': values < value, '<=': values <= value,
+                '>': values > value, '>=': values >= value}[op].to_numpy()
+    return mask
+
+def open_dataset(path):
+    import pyarrow.dataset as ds
+    import pyarrow.fs as fs
+
+    ## Memory mapped, so forked workers reading the same file share its pages
+    return ds.dataset(path, format='parquet' if path.endswith('.parquet') else 'ipc',
+                      filesystem=fs.LocalFileSystem(use_mmap=True))
+
+def index_columns(schema):
+    ## Columns holding the stored pandas index
+    pandas_meta = schema.pandas_metadata or {}
+    return [column for column in pandas_meta.get('index_columns', [])
+            if isinstance(column, str)]
+
+def resolve_filters(schema, filters):
+    ## As with pickles, a filter on a column that isn't stored
+    ## goes to the stored index when there's only one
+    index = index_columns(schema)
+    if not filters or len(index) != 1:
+        return filters
+    return [(index[0] if column not in schema.names else column, op, value)
+            for column, op, value in filters]
+
+def project(schema, columns):
+    ## The stored pandas index is kept with the selected columns
+    if columns is None:
+        return None
+    columns = list(columns) + [column for column in index_columns(schema) if column not in columns]
+    return [column for column in columns if column in schema.names]
+
+def count_rows(path):
+    ## Rows stored in a table before any filters, from the file metadata
+    ## None for pickled tables, which can't be counted without reading them
+    path = find_table(path)
+    if path.endswith('.pkl'):
+        return None
+    return open_dataset(path).count_rows()
+
+def read_table(path, columns=None, filters=None):
+    path = find_table(path)
+    if path.endswith('.pkl'):
+        data = pd.read_pickle(path)
+        if filters:
+            data = data[filter_mask(data, filters)]
+        if columns is not None:
+            data = data[[column for column in columns if column in data.columns]]
+        return data
+
+    dataset = open_dataset(path)
+    filters = resolve_filters(dataset.schema, filters)
+    expression = filter_expression(filters) if filters else None
+    return dataset.to_table(columns=project(dataset.schema, columns), 
+                            filter=expression).to_pandas()
+
+def iter_batches(path, columns=None, filters=None, batch_rows=1000000):
+    ## Arrow record batches of a table, batch_rows at a time and in file order
+    ## Pickled tables can't be streamed, so they're read whole and split up
+    import pyarrow as pa
+
+    path = find_table(path)
+    if path.endswith('.pkl'):
+        table = pa.Table.from_pandas(read_table(path, columns, filters))
+        yield from table.to_batches(max_chunksize=batch_rows)
+        return
+
+    dataset = open_dataset(path)
+    filters = resolve_filters(dataset.schema, filters)
+    expression = filter_expression(filters) if filters else None
+    yield from dataset.to_batches(columns=project(dataset.schema, columns), filter=expression, 
+                                  batch_size=batch_rows, use_threads=False)
+
+def write_table(data, path):
+    ## Writes Parquet unless path ends with .feather (uncompressed, for memory mapping)
+    ## target is stored as a categorical
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    if 'target' in data.columns:
+        data = data.assign(target=data.target.astype('category'))
+
+    stem = table_stem(path)
+    Path(stem).parent.mkdir(parents=True, exist_ok=True)
+    if str(path).endswith('.feather'):
+        feather.write_feather(pa.Table.from_pandas(data), f'{stem}.feather',
+                              compression='uncompressed')
+    else:
+        data.to_parquet(f'{stem}.parquet', engine='pyarrow')
+
+def convert_table(path, ext='parquet'):
+    ## Rewrites a pickled table (e.g. a corpus' *_indexed_words.pkl) next to the original
+    data = pd.read_pickle(path)
+    write_table(data, f'{table_stem(path)}.{ext}')
+    print(f'{len(data):,} rows written to {table_stem(path)}.{ext}')
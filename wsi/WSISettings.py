@@ -1,4 +1,5 @@
 from collections import namedtuple
+import os
 ModelInfo = namedtuple('ModelInfo', ['name', 'language', 'vocab_size'])
 
 models = {
@@ -19,19 +20,88 @@ WSISettings = namedtuple('WSISettings', [
     'cuda_device', 'init_num_senses', 'subset_num',
     'disable_tfidf', 'disable_lemmatization', 
     'bert_model', 'language',
-    'max_batch_size', 'prediction_cutoff' ])
+    'max_batch_size', 'prediction_cutoff',
+    'prediction_density', 'vocab_cache_dir',
+    'max_batch_tokens', 'cpu_threads', 'cpu_interop_threads',
+    'quantize', 'prefetch_batches',
+    'cuda_devices', 'max_chunk_rows',
+    'mixed_precision', 'precision_check_size',
+    'trim_on_device', 'trim_cutoff', 'trim_threshold',
+    'cluster_backend', 'cluster_dims', 'kmeans_clusters',
+    'cluster_workers', 'assign_chunk_rows', 'assign_workers',
+    'random_seed', 'stratify_by', 'other_prediction_cutoff',
+    'plot_workers' ])
 
 DEFAULT_PARAMS = WSISettings(
     ## Cutoff for the dendrogram based on last n merges
     init_num_senses=15,
     ## Number of term instances that will be used for clustering
     subset_num=10000,
-    cuda_device=1,
+    ## The subset is drawn with this seed before predicting, and saved with the predictions
+    random_seed=0,
+    ## Column of the target data the subset is stratified by, e.g. 'corpus'
+    ## (the time slice for COHA); None samples each target's rows evenly
+    stratify_by=None,
+    ## Top predictions kept for instances outside the subset, which are only assigned
+    ## to their closest sense; None keeps prediction_cutoff for them too
+    other_prediction_cutoff=None,
+    ## How the dendrogram is built, see wsi_clustering.CLUSTER_BACKENDS
+    ## ward, pca_ward, projection_ward, kmeans_ward or nn_chain_ward
+    cluster_backend='ward',
+    ## Dimensions kept by pca_ward and projection_ward
+    cluster_dims=100,
+    ## Centroids found by kmeans_ward before they are merged
+    kmeans_clusters=1000,
+    ## Processes clustering targets at the same time
+    cluster_workers=1,
+    ## Instances outside the clustered subset are assigned to senses this many rows at a time,
+    ## by this many threads
+    assign_chunk_rows=20000,
+    assign_workers=1,
+    ## Processes making the cluster plots once every target is clustered
+    plot_workers=1,
+    ## -1 (or no CUDA available) runs on CPU
+    cuda_device=int(os.environ.get('WSI_CUDA_DEVICE', 1)),
+    ## Set to more than one device (e.g. (0, 1, 2, 3)) to split targets
+    ## between one worker process per device; -1 entries are CPU workers
+    cuda_devices=None,
+    ## Bigger targets are split into chunks of this many rows between devices
+    max_chunk_rows=50000,
     ## BERT settings
     disable_lemmatization=True,
     disable_tfidf=False,
+    ## Batches hold up to max_batch_size instances
+    ## and up to max_batch_tokens padded BERT tokens
     max_batch_size=32,
+    max_batch_tokens=8192,
+    ## fp16 (GPU) / bf16 (CPU) autocast for BERT
+    mixed_precision=False,
+    ## Instances compared against fp32 before predicting with mixed precision; 0 skips
+    precision_check_size=500,
+    ## Batches padded ahead of the model on a worker thread; 0 disables
+    prefetch_batches=4,
     language=model.language,
-    prediction_cutoff=model.vocab_size,
-    bert_model=model.name
+    ## Number of top predictions kept per instance
+    ## Trimming stops at a prob of .0005, and only
+    ## the top 2000 terms can have a prob above that
+    prediction_cutoff=2000,
+    ## Optionally keep fewer terms, stopping at this cumulative prob
+    prediction_density=None,
+    ## Substitutes are trimmed to the terms above trim_threshold,
+    ## up to a cumulative prob of trim_cutoff
+    trim_cutoff=1,
+    trim_threshold=.0005,
+    ## Trim while predicting, so only the kept terms are saved
+    ## Instances then have no probs for terms only kept by other instances
+    ## Needs disable_lemmatization, as lemma probs are summed before trimming
+    trim_on_device=False,
+    bert_model=model.name,
+    ## Where the lemmatized vocab tables are cached; None disables caching
+    vocab_cache_dir='~/.cache/masking',
+    ## CPU settings
+    ## None keeps torch's defaults
+    cpu_threads=None,
+    cpu_interop_threads=None,
+    ## int8 dynamic quantization of the linear layers
+    quantize=False
 )
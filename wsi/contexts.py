@@ -0,0 +1,86 @@
+from collections import namedtuple
+from pathlib import Path
+import pandas as pd
+import numpy as np
+
+## Pre-tokenized contexts, one row per instance (word_idx)
+## pre_ids and post_ids are the BERT token ids of the text before and after the target,
+## with rows split by the CSR style indptr arrays
+## text_hashes are hashes of each instance's text, see context_hashes
+TokenizedContexts = namedtuple('TokenizedContexts', [
+    'inst_ids', 'pre_indptr', 'pre_ids', 'post_indptr', 'post_ids', 'text_hashes'])
+
+def stack_contexts(inst_ids, pre_lens, pre_ids, post_lens, post_ids, text_hashes):
+    def to_indptr(lens):
+        indptr = np.zeros(len(inst_ids) + 1, dtype=np.int64)
+        np.cumsum(lens, out=indptr[1:])
+        return indptr
+
+    return TokenizedContexts(
+        np.asarray(inst_ids),
+        to_indptr(pre_lens), np.asarray(pre_ids, dtype=np.int32),
+        to_indptr(post_lens), np.asarray(post_ids, dtype=np.int32),
+        np.asarray(text_hashes, dtype=np.uint64))
+
+def merge_contexts(contexts, new_contexts):
+    if contexts is None:
+        return new_contexts
+
+    return TokenizedContexts(
+        np.concatenate([contexts.inst_ids, new_contexts.inst_ids]),
+        np.concatenate([contexts.pre_indptr[:-1],
+                        new_contexts.pre_indptr + contexts.pre_indptr[-1]]),
+        np.concatenate([contexts.pre_ids, new_contexts.pre_ids]),
+        np.concatenate([contexts.post_indptr[:-1],
+                        new_contexts.post_indptr + contexts.post_indptr[-1]]),
+        np.concatenate([contexts.post_ids, new_contexts.post_ids]),
+        np.concatenate([contexts.text_hashes, new_contexts.text_hashes]))
+
+def context_tokens(contexts, row):
+    pre = contexts.pre_ids[contexts.pre_indptr[row]:contexts.pre_indptr[row + 1]]
+    post = contexts.post_ids[contexts.post_indptr[row]:contexts.post_indptr[row + 1]]
+    return pre, post
+
+## The cache is only valid for the tokenizer it was made with,
+## and each row only for the text it was made from
+def save_contexts(contexts, path, vocab_hash):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    np.savez(path, vocab_hash=np.array(vocab_hash), **contexts._asdict())
+
+def load_contexts(path, vocab_hash):
+    if not Path(path).exists():
+        return None
+
+    with np.load(path, allow_pickle=True) as saved:
+        if str(saved['vocab_hash']) != vocab_hash:
+            print('Tokenized contexts were made with a different vocab, tokenizing again')
+            return None
+        if 'text_hashes' not in saved.files:
+            print('Tokenized contexts were saved without their text hashes, tokenizing again')
+            return None
+        return TokenizedContexts(*[saved[field] for field in TokenizedContexts._fields])
+
+def context_index(contexts):
+    ## Built once per set of contexts, so lookups only cost the size of the lookup
+    return None if contexts is None else pd.Index(contexts.inst_ids)
+
+def missing_instances(index, inst_ids):
+    if index is None:
+        return np.ones(len(inst_ids), dtype=bool)
+    return index.get_indexer(inst_ids) < 0
+
+def context_hashes(data):
+    ## One hash per instance of the text before and after its target,
+    ## so a corpus preprocessed again under the same word_idx values isn't matched to old tokens
+    texts = pd.DataFrame({
+        'pre': [pre for pre, _, _ in data.formatted_sent],
+        'post': [post for _, _, post in data.formatted_sent]})
+    return pd.util.hash_pandas_object(texts, index=False).to_numpy()
+
+def changed_instances(contexts, index, inst_ids, text_hashes):
+    ## Whether any cached instance was tokenized from different text
+    if index is None:
+        return False
+    rows = index.get_indexer(inst_ids)
+    found = rows >= 0
+    return bool((contexts.text_hashes[rows[found]] != text_hashes[found]).any())
@@ -1,23 +1,75 @@
-from transformers import BertForMaskedLM, BertTokenizer
+from transformers import BertForMaskedLM, BertTokenizerFast
 # from transformers import pipeline
 from nltk.corpus import stopwords
 from tqdm import tqdm
+from wsi.predictions import stack_predictions
+from wsi.contexts import (stack_contexts, merge_contexts, context_tokens,
+                          save_contexts, load_contexts, missing_instances,
+                          context_index, context_hashes, changed_instances)
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from pathlib import Path
 import multiprocessing
+import queue
+import itertools
+import hashlib
+import pickle
+import os
 import numpy as np
-import pandas as pd
 import torch
 import spacy
 import re
 
-def get_batches(from_iter, group_size):
-    ret = []
-    for _, x in from_iter:
-        ret.append(x)
-        if len(ret) == group_size:
-            yield ret
-            ret = []
-    if ret:
-        yield ret
+## Bump when the cached vocab tables change format
+VOCAB_CACHE_VERSION = 1
+
+## Patterns that can be built from pre-tokenized contexts
+## Other patterns are tokenized per instance
+CONTEXT_PATTERNS = {
+    '{pre} {target_predict} {post}': '{target_predict}',
+    '{pre} {mask_predict} {post}': '{mask_predict}'}
+
+def pad_batch(token_ids):
+    # Right pads sentences to make all the same length
+    max_len = max(len(x) for x in token_ids)
+    batch_input = np.zeros((len(token_ids), max_len), dtype=np.int64)
+    for idx, vals in enumerate(token_ids):
+        batch_input[idx, 0:len(vals)] = vals
+    return batch_input
+
+def prefetch(items, size):
+    ## Pulls items from the generator on a worker thread,
+    ## keeping up to size of them ready ahead of the consumer
+    if size <= 0:
+        yield from items
+        return
+
+    ready = queue.Queue(maxsize=size)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                ready.put(item)
+        except Exception as error:
+            ready.put(error)
+        ready.put(done)
+
+    Thread(target=produce, daemon=True).start()
+    while (item := ready.get()) is not done:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def set_cpu_threads(settings):
+    if settings.cpu_threads is not None:
+        torch.set_num_threads(settings.cpu_threads)
+    if settings.cpu_interop_threads is not None:
+        ## Can only be set before any inter-op work has started
+        try:
+            torch.set_num_interop_threads(settings.cpu_interop_threads)
+        except RuntimeError:
+            print('Inter-op threads were already set, skipping')
 
 def apply_softmax(values):
     e_x = np.exp(values - np.max(values))
@@ -46,75 +98,172 @@ def trim_predictions_count(
     print(num_words[:5])
     return likelihoods[shared_words]
 
-def trim_predictions(
-    likelihoods, targets, language, cutoff=1, threshold=.0005):
-    stops = stopwords.words(language)
-    stops.remove('no')
-    stops.extend(targets)
-
-    shared_words = set()
-    num_words = []
-    for inst_id, probs in likelihoods.iterrows(): 
-        probs = probs.sort_values(ascending=False)
-
-        cumulative_density = 0
-        num = 0
-        for predicted_word, prob in probs.iteritems():
-            filtered_word = re.sub(r'[^a-z]', '', predicted_word)
-            if len(filtered_word) <= 2 or filtered_word in stops:
-                continue
-             
-            shared_words.add(predicted_word)
-            cumulative_density += prob
-            num += 1
-            if cumulative_density >= cutoff or prob < threshold:
-                break
-        num_words.append(num)
-
-    # print(len(shared_words), sum(num_words)//len(num_words))
-    # print(num_words[:5])
-    ## TODO: some columns are the same, should use numerical ids instead of words to select
-    return shared_words
+def get_vocab_filter(vocab, language):
+    ## Letters only form of each vocab word, and whether it's long enough
+    ## and not a stopword; only needs to be made once per vocab and language
+    stops = set(stopwords.words(language)) - {'no'}
+    filtered = np.array([re.sub(r'[^a-z]', '', word) for word in vocab])
+    eligible = np.array([len(word) > 2 and word not in stops for word in filtered])
+    return filtered, eligible
+
+def eligible_vocab_mask(vocab_filter, targets):
+    ## The target's own forms are not kept as substitutes either
+    filtered, eligible = vocab_filter
+    return eligible & ~np.isin(filtered, targets)
+
+def trim_predictions(predictions, eligible, cutoff=1, threshold=.0005):
+    ## Keeps each row's most likely eligible terms, stopping after the term where
+    ## the cumulative density reaches cutoff or the prob drops below threshold
+    ## Returns the vocab ids kept by any row
+    matrix = predictions.matrix
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+    ## Sort every row by prob, descending, then drop ineligible terms
+    order = np.lexsort((-matrix.data, rows))
+    order = order[eligible[matrix.indices[order]]]
+    vocab_ids = matrix.indices[order]
+    probs = matrix.data[order].astype(np.float64)
+    rows = rows[order]
+    if len(rows) == 0:
+        return vocab_ids
+
+    ## Cumulative density of the terms before each one, within its row
+    row_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    row_lens = np.diff(np.r_[row_starts, len(rows)])
+    density_before = np.cumsum(probs) - probs
+    density_before -= np.repeat(density_before[row_starts], row_lens)
+
+    ## Probs are descending, so the previous term is the smallest one before
+    prob_before = np.r_[np.inf, probs[:-1]]
+    prob_before[row_starts] = np.inf
+
+    kept = (density_before < cutoff) & (prob_before >= threshold)
+    return np.unique(vocab_ids[kept])
+
+SP_MODELS = {
+    "english": "en_core_web_sm",
+    "spanish": "es_core_news_sm"}
+
+def load_spacy(sp_model):
+    return spacy.load(sp_model, disable=['ner', 'parser'])
+
+def load_tokenizer(bert_model):
+    tokenizer = BertTokenizerFast.from_pretrained(bert_model)
+    ## The fast tokenizer's vocab isn't ordered, so sort it by id
+    vocab_tokens = [token for token, _ in sorted(
+        tokenizer.get_vocab().items(), key=lambda item: item[1])]
+    vocab_hash = hashlib.sha1('\n'.join(vocab_tokens).encode('utf-8')).hexdigest()
+    return tokenizer, vocab_tokens, vocab_hash
+
+def lemmatize_vocab(vocab_tokens, sp_model):
+    ## Runs a spaCy process per CPU, which a daemonic pool worker can't start,
+    ## so multi-device runs build the tables before starting their workers
+    nlp = load_spacy(sp_model)
+    lemmatized_vocab = []
+    original_vocab = []
+    for spacyed in tqdm(
+            nlp.pipe(vocab_tokens, 
+            batch_size=1000, n_process=multiprocessing.cpu_count()),
+            total=len(vocab_tokens), 
+            desc='lemmatizing vocab'):
+        lemma = spacyed[0].lemma_ if spacyed[0].lemma_ != '-PRON-' else spacyed[0].lower_
+        lemmatized_vocab.append(lemma)
+        original_vocab.append(spacyed[0].lower_)
+    return original_vocab, lemmatized_vocab
+
+def load_vocab_tables(settings, vocab_tokens=None, vocab_hash=None):
+    ## Lemmatizing the vocab is slow, so the tables are cached
+    ## per (model, spaCy model, language) and rebuilt if the vocab or spaCy changes
+    ## Multi-device runs call this once before starting their workers
+    ## and pass the tables to each worker's LMBert, without loading the model
+    if vocab_tokens is None:
+        _, vocab_tokens, vocab_hash = load_tokenizer(settings.bert_model)
+    sp_model = SP_MODELS[settings.language]
+    if settings.vocab_cache_dir is None:
+        return lemmatize_vocab(vocab_tokens, sp_model)
+
+    cache_dir = Path(settings.vocab_cache_dir).expanduser()
+    cache_name = re.sub(r'[^\w.-]', '_',
+        f'{settings.bert_model}_{sp_model}_{settings.language}')
+    cache_path = cache_dir / f'{cache_name}.pkl'
+
+    cache_key = {
+        'version': VOCAB_CACHE_VERSION,
+        'vocab_hash': vocab_hash,
+        'spacy_version': spacy.__version__}
+
+    if cache_path.exists():
+        with open(cache_path, 'rb') as fin:
+            cached = pickle.load(fin)
+        if cached['key'] == cache_key:
+            return cached['original'], cached['lemmatized']
+        print('Vocab cache is out of date, lemmatizing again')
+
+    original_vocab, lemmatized_vocab = lemmatize_vocab(vocab_tokens, sp_model)
+
+    ## Written to a temp file first so parallel runs never read a partial cache
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as fout:
+        pickle.dump({
+            'key': cache_key,
+            'original': original_vocab,
+            'lemmatized': lemmatized_vocab}, 
+            fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+    return original_vocab, lemmatized_vocab
 
 class LMBert():
-    def __init__(self, settings):
-        if settings.cuda_device >= 0:
+    def __init__(self, settings, vocab_tables=None):
+        if settings.cuda_device >= 0 and torch.cuda.is_available():
             device = torch.device(f'cuda:{settings.cuda_device}')  
         else:
-            torch.device('cpu')
+            if settings.cuda_device >= 0:
+                print('CUDA is not available, running on CPU')
+            device = torch.device('cpu')
+            set_cpu_threads(settings)
 
         with torch.no_grad():
             model = BertForMaskedLM.from_pretrained(settings.bert_model, output_hidden_states=True)
             model.cls.predictions = model.cls.predictions.transform
             model.to(device=device)
             model.eval()
+
+            ## int8 weights for the linear layers; only supported on CPU
+            if settings.quantize and device.type == 'cpu':
+                model = torch.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8)
             self.bert = model
             self.device = device
-            self.tokenizer = BertTokenizer.from_pretrained(
-                settings.bert_model)
+            self.tokenizer, self.vocab_tokens, self.vocab_hash = load_tokenizer(settings.bert_model)
+            self.contexts = None
+            self._context_index = None
 
             self.max_sent_len = model.config.max_position_embeddings
+            self.vocab_size = model.config.vocab_size
             self.max_batch_size = settings.max_batch_size
-            self.lemmatized_vocab = []
-            self.original_vocab = []
-
-            sp_models = {
-                "english": "en_core_web_sm",
-                "spanish": "es_core_news_sm"}
-
-            nlp = spacy.load(sp_models[settings.language], 
-                             disable=['ner', 'parser'])
-            self._lemmas_cache = {}
-            self._spacy = nlp
-            for spacyed in tqdm(
-                    nlp.pipe(self.tokenizer.vocab.keys(), 
-                    batch_size=1000, n_process=multiprocessing.cpu_count()),
-                    total=len((self.tokenizer.vocab)), 
-                    desc='lemmatizing vocab'):
-                lemma = spacyed[0].lemma_ if spacyed[0].lemma_ != '-PRON-' else spacyed[0].lower_
-                self._lemmas_cache[spacyed[0].lower_] = lemma
-                self.lemmatized_vocab.append(lemma)
-                self.original_vocab.append(spacyed[0].lower_)
+            self._default_batch_tokens = settings.max_batch_tokens
+            self.max_batch_tokens = settings.max_batch_tokens
+            self.prefetch_batches = settings.prefetch_batches
+
+            ## Mixed precision runs in fp16 on GPU and bf16 on CPU
+            self.autocast_dtype = None
+            if settings.mixed_precision:
+                self.autocast_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+            self._sp_model = SP_MODELS[settings.language]
+            self._spacy = None
+            if vocab_tables is None:
+                vocab_tables = load_vocab_tables(settings, self.vocab_tokens, self.vocab_hash)
+            self.original_vocab, self.lemmatized_vocab = vocab_tables
+            self._lemmas_cache = dict(zip(self.original_vocab, self.lemmatized_vocab))
+            self._vocab_filter = None
+
+    def _load_spacy(self):
+        if self._spacy is None:
+            self._spacy = load_spacy(self._sp_model)
+        return self._spacy
 
     def format_sentence_to_pattern(self, pre, target, post, pattern):
         replacements = dict(pre=pre, target=target, post=post)
@@ -131,153 +280,317 @@ class LMBert():
         if word in self._lemmas_cache:
             return self._lemmas_cache[word]
         else:
-            spacyed = self._spacy(word)
+            spacyed = self._load_spacy()(word)
             lemma = spacyed[0].lemma_ if spacyed[0].lemma_ != '-PRON-' else spacyed[0].lower_
             self._lemmas_cache[word] = lemma
             return lemma
 
-    def predict_sent_substitute_representatives(self, data_subset, settings, target):
+    def _tokenize_contexts(self, data, chunk_size=10000):
+        ## Batch tokenizes the text before and after each target with the fast tokenizer
+        ## Patterns of the form "{pre} {target} {post}" tokenize the same as the parts alone
+        sents = data.formatted_sent.tolist()
+        pre_lens, pre_ids, post_lens, post_ids = [], [], [], []
+        for start in tqdm(range(0, len(sents), chunk_size), desc='tokenizing contexts'):
+            chunk = sents[start:start + chunk_size]
+            for texts, lens, ids in [
+                    ([pre for pre, _, _ in chunk], pre_lens, pre_ids),
+                    ([post for _, _, post in chunk], post_lens, post_ids)]:
+                encoded = self.tokenizer(texts, add_special_tokens=False)['input_ids']
+                lens.extend(len(x) for x in encoded)
+                ids.append(np.fromiter(itertools.chain.from_iterable(encoded), dtype=np.int32))
+
+        return stack_contexts(data.word_idx.to_numpy(), 
+            pre_lens, np.concatenate(pre_ids), post_lens, np.concatenate(post_ids),
+            context_hashes(data))
+
+    def tokenize_contexts(self, data, cache_path=None):
+        ## Tokenizes every instance once, reusing and extending the cache on disk
+        ## so later prediction runs skip tokenization
+        contexts, index = self.contexts, self._context_index
+        if contexts is None and cache_path is not None:
+            contexts = load_contexts(cache_path, self.vocab_hash)
+            index = context_index(contexts)
+
+        ## Contexts of a corpus that was preprocessed again are all tokenized again
+        if changed_instances(contexts, index, data.word_idx, context_hashes(data)):
+            print('Contexts changed since they were tokenized, tokenizing again')
+            contexts, index = None, None
+
+        ## The index is only rebuilt when rows were added
+        missing = missing_instances(index, data.word_idx)
+        if missing.any():
+            contexts = merge_contexts(contexts, self._tokenize_contexts(data[missing]))
+            index = context_index(contexts)
+            if cache_path is not None:
+                save_contexts(contexts, cache_path, self.vocab_hash)
+
+        self.contexts = contexts
+        self._context_index = index
+
+    def _encode_instances(self, data_subset, target, pattern_str):
+        ## Converts every instance to BERT token ids, once per pattern
+        ## Skip target here to use the passed in target instead
+        if missing_instances(self._context_index, data_subset.word_idx).any():
+            self.tokenize_contexts(data_subset)
+        rows = self._context_index.get_indexer(data_subset.word_idx)
+
+        cls_id, sep_id, mask_id = self.tokenizer.convert_tokens_to_ids(['[CLS]', '[SEP]', '[MASK]'])
+        predicted_ids = {
+            '{target_predict}': self.tokenizer(target, add_special_tokens=False)['input_ids'],
+            '{mask_predict}': [mask_id]}
+
+        encoded = []
+        for row, (inst_id, (pre, _, post)) in zip(rows, 
+                data_subset[['word_idx','formatted_sent']].itertuples(index=False)):
+            pre_ids, post_ids = context_tokens(self.contexts, row)
+
+            sents = []
+            for pattern in pattern_str:
+                if pattern in CONTEXT_PATTERNS:
+                    ids = np.concatenate([[cls_id], pre_ids, 
+                        predicted_ids[CONTEXT_PATTERNS[pattern]], post_ids, [sep_id]])
+                    sents.append((ids, len(pre_ids) + 1))
+                else:
+                    tokens, target_idx = self.format_sentence_to_pattern(pre, target, post, pattern)
+                    sents.append((self.tokenizer.convert_tokens_to_ids(tokens), target_idx))
+            encoded.append((inst_id, sents))
+        return encoded
+
+    def _get_batches(self, encoded, max_size):
+        ## Sorted by tokenized length so padding is kept small
+        ## Batches are cut once padding to the newest (longest) instance
+        ## would go past max_batch_tokens, which can be lowered on OOM
+        encoded = sorted(encoded, key=lambda inst: max(len(ids) for ids, _ in inst[1]))
+        ret = []
+        for inst in encoded:
+            padded_len = len(inst[1]) * max(len(ids) for ids, _ in inst[1])
+            if ret and (len(ret) == max_size or
+                        (len(ret) + 1) * padded_len > self.max_batch_tokens):
+                yield ret
+                ret = []
+            ret.append(inst)
+        if ret:
+            yield ret
+
+    def _prepare_batch(self, batch):
+        # Num patterns x num sentences, ordered by instance then pattern
+        batch_sents = [sent for _, sents in batch for sent in sents]
+        input_ids = torch.from_numpy(pad_batch([ids for ids, _ in batch_sents]))
+        target_idxs = torch.tensor([target_idx for _, target_idx in batch_sents], dtype=torch.long)
+
+        # Pinned memory lets the copy to the GPU run without blocking
+        if self.device.type == 'cuda':
+            input_ids = input_ids.pin_memory()
+            target_idxs = target_idxs.pin_memory()
+        return batch, input_ids, target_idxs
+
+    def _run_with_backoff(self, run_batch, prepared):
+        ## Retries a batch that ran out of memory in halves
+        ## and lowers the token budget for the batches still to come in this call
+        batch = prepared[0]
+        try:
+            with torch.autocast(self.device.type, dtype=self.autocast_dtype,
+                                enabled=self.autocast_dtype is not None):
+                return run_batch(prepared)
+        except torch.cuda.OutOfMemoryError:
+            if len(batch) == 1:
+                raise
+
+        torch.cuda.empty_cache()
+        self.max_batch_tokens = max(self.max_batch_tokens // 2, 1)
+        print(f'Out of memory; lowered the batch token budget to {self.max_batch_tokens}')
+
+        half = len(batch) // 2
+        first = self._run_with_backoff(run_batch, self._prepare_batch(batch[:half]))
+        second = self._run_with_backoff(run_batch, self._prepare_batch(batch[half:]))
+        return tuple(torch.cat(parts) for parts in zip(first, second))
+
+    def _forward(self, prepared):
+        _, input_ids, target_idxs = prepared
+
+        # Makes vectors into tensors
+        torch_input_ids = input_ids.to(device=self.device, non_blocking=True)
+        target_idxs = target_idxs.to(device=self.device, non_blocking=True)
+
+        # TODO: input attention mask can be applied here
+        torch_mask = torch_input_ids != 0
+
+        # Logits: pred. scores (for each vocabulary token before SoftMax)
+        pred_results = self.bert(torch_input_ids, attention_mask=torch_mask)
+
+        sent_idxs = torch.arange(len(target_idxs), device=self.device)
+        return pred_results, sent_idxs, target_idxs
+
+    def _to_host(self, outputs):
+        ## Starts copying the outputs back without waiting on them
+        ## The returned event marks when the copies are done
+        if self.device.type != 'cuda':
+            return outputs, None
+
+        host_outputs = []
+        for output in outputs:
+            host_output = torch.empty(output.shape, dtype=output.dtype, pin_memory=True)
+            host_output.copy_(output, non_blocking=True)
+            host_outputs.append(host_output)
+
+        ready = torch.cuda.Event()
+        ready.record(torch.cuda.current_stream(self.device))
+        return host_outputs, ready
+
+    @staticmethod
+    def _handle_outputs(handle_batch, batch, outputs, ready):
+        if ready is not None:
+            ready.synchronize()
+        handle_batch(batch, *[output.numpy() for output in outputs])
+
+    def _run_batches(self, encoded, max_size, run_batch, handle_batch):
+        ## Producer / consumer pipeline around the model:
+        ## batches are padded ahead of time on a worker thread,
+        ## and outputs are handled on a writer thread once copied back,
+        ## so the device never waits on Python between batches
+        ## Each call starts from the full token budget, whatever earlier calls lowered it to
+        self.max_batch_tokens = self._default_batch_tokens
+        batches = (self._prepare_batch(batch) 
+                   for batch in self._get_batches(encoded, max_size))
+
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            handled = []
+            for prepared in tqdm(prefetch(batches, self.prefetch_batches)):
+                outputs = self._run_with_backoff(run_batch, prepared)
+                outputs, ready = self._to_host(outputs)
+
+                # A single writer keeps the batches in order
+                handled.append(writer.submit(
+                    self._handle_outputs, handle_batch, prepared[0], outputs, ready))
+
+            for result in handled:
+                result.result()
+
+    def _eligible_vocab(self, settings, target_alts):
+        ## Same mask trim_predictions uses when clustering, on the device
+        ## Clustering sums the probs of each lemma before trimming, which can't be done
+        ## on the kept tokens alone, so trimming here needs lemmatization disabled
+        if not settings.disable_lemmatization:
+            raise ValueError('trim_on_device needs disable_lemmatization, '
+                             'since lemma probs are summed before trimming')
+        if self._vocab_filter is None:
+            self._vocab_filter = get_vocab_filter(self.original_vocab, settings.language)
+
+        eligible = eligible_vocab_mask(self._vocab_filter, target_alts)
+        return torch.from_numpy(eligible).to(device=self.device)
+
+    def predict_sent_substitute_representatives(self, data_subset, settings, target, target_alts=None):
         patterns = [('{pre} {target_predict} {post}', 1)]
         n_patterns = len(patterns)
         pattern_str, pattern_weights = list(zip(*patterns))
         pattern_weights = torch.from_numpy(np.array(pattern_weights, dtype=np.float32).reshape(-1, 1)).to(device=self.device)
-        num_predictions = settings.prediction_cutoff
+        num_predictions = min(settings.prediction_cutoff, self.vocab_size)
+        density = settings.prediction_density
+
+        ## Optionally trim the substitutes here instead of when clustering
+        eligible = None
+        if settings.trim_on_device:
+            eligible = self._eligible_vocab(settings, target_alts or [target])
+
+        def predict_batch(prepared):
+            pred_results, sent_idxs, target_idxs = self._forward(prepared)
+            logits_all_tokens = pred_results.logits
+            #attention = pred_results.attentions
+
+            # Select the logits for the masked term, one gather for the whole batch
+            # Logit shape: 1 per sentence x 1 per word x 768 (hidden state size)
+            logits_target_tokens = logits_all_tokens[sent_idxs, target_idxs]
+
+            # Combine the multiple pattern versions of a sentence into one
+            logits_target_tokens_joint_patt = (
+                logits_target_tokens.view(-1, n_patterns, logits_target_tokens.shape[1])
+                * pattern_weights.view(1, n_patterns, 1)).sum(1)
+
+            # Softmax is applied to the vocab to get the probs 
+            pre_softmax = torch.matmul(
+            logits_target_tokens_joint_patt,
+            self.bert.bert.embeddings.word_embeddings.weight.transpose(0, 1))
+
+            # Apply softmax over the full vocab, then get top terms for each sentence
+            # Kept in fp32 under mixed precision
+            probs = torch.softmax(pre_softmax.float(), -1)
+
+            # Ineligible terms are zeroed so they sort last
+            if eligible is not None:
+                probs = probs * eligible
+            topk_probs, topk_idxs = torch.topk(probs, num_predictions, -1)
+
+            # Trimming keeps terms until the one where the cumulative prob reaches
+            # the cutoff or the prob drops below the threshold, as in trim_predictions
+            if eligible is not None:
+                density_before = torch.cumsum(topk_probs, -1) - topk_probs
+                prob_before = torch.cat([torch.full_like(topk_probs[:, :1], float('inf')),
+                                         topk_probs[:, :-1]], -1)
+                keep = ((density_before < settings.trim_cutoff) 
+                        & (prob_before >= settings.trim_threshold) 
+                        & (topk_probs > 0))
+
+            # Optionally only keep terms until the cumulative prob reaches the density
+            # The term that crosses the density is kept
+            elif density is not None:
+                cumulative = torch.cumsum(topk_probs, -1)
+                keep = (cumulative - topk_probs) < density
+            else:
+                keep = torch.ones_like(topk_probs, dtype=torch.bool)
+
+            return topk_probs, topk_idxs, keep
+
+        inst_ids = []
+        pred_idxs = []
+        pred_probs = []
+        pred_counts = []
+
+        def collect_batch(batch, probs_batch, topk_idxs_batch, keep_batch):
+            # Flattening by the mask keeps each row's terms in descending order
+            inst_ids.extend(inst_id for inst_id, _ in batch)
+            pred_idxs.append(topk_idxs_batch[keep_batch])
+            pred_probs.append(probs_batch[keep_batch])
+            pred_counts.append(keep_batch.sum(1))
 
         with torch.no_grad():
-            sorted_by_len = data_subset.sort_values(by="length")[['word_idx','formatted_sent']]
-            inst_ids = []
-            predictions = []
-
-            batch_generator = get_batches(sorted_by_len.iterrows(),
-                            self.max_batch_size // n_patterns)
-            # breakpoint()
-            for batch in tqdm(batch_generator, total=len(data_subset) // self.max_batch_size):
-                # Converts the sentences to BERT format
-                # Num patterns x num sentences
-                batch_sents = []
-                # Skip target here to use the passed in target instead
-                for inst_id, (pre, _, post) in batch:
-                    for pattern in pattern_str:
-                        formatted_sent = self.format_sentence_to_pattern(pre, target, post, pattern)
-                        batch_sents.append(formatted_sent)
-
-                # Converts terms to BERT tokens
-                tokenized_sents_vocab_idx = [self.tokenizer.convert_tokens_to_ids(sent[0]) for sent in batch_sents]
-
-                # Right pads sentences to make all the same length
-                max_len = max(len(x) for x in tokenized_sents_vocab_idx)
-                batch_input = np.zeros((len(tokenized_sents_vocab_idx), max_len), dtype=np.int64)
-
-                for idx, vals in enumerate(tokenized_sents_vocab_idx):
-                    batch_input[idx, 0:len(vals)] = vals
-
-                # Makes vectors into tensors
-                torch_input_ids = torch.tensor(batch_input, dtype=torch.long).to(device=self.device)
-
-                # TODO: input attention mask can be applied here
-                torch_mask = torch_input_ids != 0
-
-                # Logits: pred. scores (for each vocabulary token before SoftMax)
-                pred_results = self.bert(torch_input_ids, attention_mask=torch_mask)
-                logits_all_tokens = pred_results.logits
-                #attention = pred_results.attentions
-
-                # Select the logits for the masked term
-                # Logit shape: 1 per sentence x 1 per word x 768 (hidden state size)
-                logits_target_tokens = torch.zeros((len(batch_sents), logits_all_tokens.shape[2])).to(self.device)
-                for i in range(0, len(batch_sents)):
-                    logits_target_tokens[i, :] = logits_all_tokens[i, batch_sents[i][1], :]
-
-                # Combine the multiple pattern versions of a sentence into one 
-                logits_target_tokens_joint_patt = torch.zeros(
-                    (len(batch_sents) // n_patterns, logits_target_tokens.shape[1])).to(
-                    self.device)
-                    
-                for i in range(0, len(batch_sents), n_patterns):
-                    logits_target_tokens_joint_patt[i // n_patterns, :] = (
-                            logits_target_tokens[i:i + n_patterns, :] * pattern_weights).sum(0)
-
-                # Softmax is applied to the vocab to get the probs 
-                pre_softmax = torch.matmul(
-                logits_target_tokens_joint_patt,
-                self.bert.bert.embeddings.word_embeddings.weight.transpose(0, 1))
+            encoded = self._encode_instances(data_subset, target, pattern_str)
+            self._run_batches(encoded, self.max_batch_size // n_patterns,
+                              predict_batch, collect_batch)
 
-                # Get top terms for each sentence
-                topk_vals, topk_idxs = torch.topk(pre_softmax, num_predictions, -1)
+        # The trimmed columns are recorded so clustering can skip trimming
+        selected = None
+        if eligible is not None:
+            selected = np.unique(np.concatenate(pred_idxs)) if pred_idxs else np.zeros(0, dtype=np.int64)
 
-                # Apply softmax to logits
-                probs_batch = torch.softmax(topk_vals, -1).detach().cpu().numpy()
-                topk_idxs_batch = topk_idxs.detach().cpu().numpy()
+        # Rows are kept sparse; columns are the vocab ids of BERT's 30522 vocab
+        # Or BETO's 31002
+        return stack_predictions(
+            inst_ids, pred_idxs, pred_probs, pred_counts, self.vocab_size, selected)
 
-                for (inst_id, _), probs, topk_idxs in zip(batch, probs_batch, topk_idxs_batch):
-                    inst_ids.append(inst_id)
-                    predictions.append({idx : prob for idx, prob in zip(topk_idxs, probs)})
+    def get_embedded_sents(self, data_subset, target):
+        pattern_str = ('{pre} {target_predict} {post}',)
 
-        predictions = pd.DataFrame(data=predictions, index=inst_ids)
-        # predictions.head()
+        def embed_batch(prepared):
+            pred_results, sent_idxs, target_idxs = self._forward(prepared)
 
-        ## Reorder and rename columns
-        predictions = predictions[range(num_predictions)]
+            # Select the target's hidden states from every layer in one gather
+            # Hidden states: 13 x (B, |s|, 768)
+            hidden_states = torch.stack([hs[sent_idxs, target_idxs + 1]
+                                         for hs in pred_results.hidden_states[1:]])  # (12, B, 768)
 
-        # Lemmatized vocab is enabled by default
-        # That means we use BERT's 30522 vocab
-        # Or BETO's 31002
-        if settings.disable_lemmatization:
-            predictions.columns = self.original_vocab  
-        else:
-            predictions.columns = self.lemmatized_vocab
+            # get usage vectors from hidden states
+            usage_vectors = hidden_states.float().sum(0)  # (B, 768)
+            return (usage_vectors, )
 
-        return predictions
+        vectors = {}
 
-    def get_embedded_sents(self, data_subset, target):
-        pattern_str = ('{pre} {target_predict} {post}',)
+        def collect_batch(batch, usage_vectors):
+            ## Separate the hidden states by instance
+            for (inst_id, _), usage_vector in zip(batch, usage_vectors):
+                vectors[inst_id] = usage_vector
 
         with torch.no_grad():
-            sorted_by_len = data_subset.sort_values(by="length")[['word_idx','formatted_sent']]
-            vectors = {}
-
-            for batch in get_batches(sorted_by_len.iterrows(),
-                                     self.max_batch_size):
- 
-                # Converts the sentences to BERT format
-                # Num patterns x num sentences
-                batch_sents = []
-                target_locs = {}
-                for inst_id, (pre, _, post) in batch:
-                    for pattern in pattern_str:
-                        formatted_sent = self.format_sentence_to_pattern(pre, target, post, pattern)
-                        batch_sents.append(formatted_sent[0])
-                        target_locs[inst_id] = formatted_sent[1]
-
-                # Converts terms to BERT tokens
-                tokenized_sents_vocab_idx = [self.tokenizer.convert_tokens_to_ids(sent) for sent in batch_sents]
-
-                # Right pads sentences to make all the same length
-                max_len = max(len(x) for x in tokenized_sents_vocab_idx)
-                batch_input = np.zeros((len(tokenized_sents_vocab_idx), max_len), dtype=np.int64)
-                for idx, vals in enumerate(tokenized_sents_vocab_idx):
-                    batch_input[idx, 0:len(vals)] = vals
-
-                # Makes vectors into tensors
-                torch_input_ids = torch.tensor(batch_input, dtype=torch.long).to(device=self.device)
-
-                # TODO: input attention mask could be applied here
-                torch_mask = torch_input_ids != 0
-
-                # Logits: pred. scores (for each vocabulary token before SoftMax)
-                pred_results = self.bert(torch_input_ids, attention_mask=torch_mask)
-                hidden_states = [hs.detach().cpu().clone().numpy() for hs in pred_results.hidden_states]
-                #.to(self.device).detach().cpu()
-                
-                # get usage vectors from hidden states
-                hidden_states = np.stack(hidden_states)  # (13, B, |s|, 768)
-                # print(f'Expected hidden states size: (13, {len(batch)}, |{max_len}|, 768)')
-                # print('Got {}'.format(hidden_states.shape))
-                usage_vectors = np.sum(hidden_states[1:, :, :, :], axis=0)
-                
-                ## Separate the hidden states by instance
-                for inst_num, (inst_id, target_loc) in enumerate(target_locs.items()):
-                    usage_vector = usage_vectors[inst_num, target_loc+1, :]
-                    vectors[inst_id] = usage_vector
+            encoded = self._encode_instances(data_subset, target, pattern_str)
+            self._run_batches(encoded, self.max_batch_size, embed_batch, collect_batch)
                     
         return vectors
@@ -0,0 +1,67 @@
+from wsi.lm_bert import trim_predictions, get_vocab_filter, eligible_vocab_mask
+from wsi.predictions import predictions_to_frame, prediction_columns, reduce_to_lemmas
+from wsi.wsi_clustering import perform_clustering
+from sklearn.metrics import adjusted_rand_score
+import pandas as pd
+import numpy as np
+
+## Compares mixed precision predictions against fp32 on a sample of one target,
+## so mixed precision can be checked before it's used for a whole run
+
+def top_k_sets(predictions, k):
+    ## Rows are sorted by prob, so the first k ids are the top k
+    matrix = predictions.matrix
+    top_sets = []
+    for row in range(matrix.shape[0]):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        top_sets.append(set(matrix.indices[start:min(start + k, end)]))
+    return top_sets
+
+def cluster_labels(predictions, vocab, lemma_ids, target_alts, settings):
+    if lemma_ids is not None:
+        predictions = reduce_to_lemmas(predictions, lemma_ids, len(vocab))
+
+    subset_term_ids = predictions.selected
+    if subset_term_ids is None:
+        eligible = eligible_vocab_mask(get_vocab_filter(vocab, settings.language), target_alts)
+        subset_term_ids = trim_predictions(
+            predictions, eligible, settings.trim_cutoff, settings.trim_threshold)
+    pred_vectors = predictions_to_frame(predictions, subset_term_ids)
+    return pd.Series(perform_clustering(pred_vectors, settings), index=pred_vectors.index)
+
+def check_mixed_precision(lm, data_subset, target_alts, settings, k=50, seed=0):
+    sample = data_subset.sample(
+        min(settings.precision_check_size, len(data_subset)), random_state=seed)
+
+    ## Same model, with autocast switched off for the reference run
+    autocast_dtype = lm.autocast_dtype
+    lm.autocast_dtype = None
+    full_preds = lm.predict_sent_substitute_representatives(
+        sample, settings, target_alts[-1], target_alts)
+    lm.autocast_dtype = autocast_dtype
+    mixed_preds = lm.predict_sent_substitute_representatives(
+        sample, settings, target_alts[-1], target_alts)
+
+    ## Both runs use the same batches, but line the rows up by id to be safe
+    order = pd.Index(mixed_preds.inst_ids).get_indexer(full_preds.inst_ids)
+    mixed_preds = mixed_preds._replace(
+        inst_ids=mixed_preds.inst_ids[order], matrix=mixed_preds.matrix[order])
+
+    full_top = top_k_sets(full_preds, k)
+    mixed_top = top_k_sets(mixed_preds, k)
+    overlap = np.mean([len(full & mixed) / len(full | mixed)
+                       for full, mixed in zip(full_top, mixed_top)])
+    top_1 = np.mean(full_preds.matrix.indices[full_preds.matrix.indptr[:-1]]
+                    == mixed_preds.matrix.indices[mixed_preds.matrix.indptr[:-1]])
+
+    vocab, lemma_ids = prediction_columns(lm.original_vocab, lm.lemmatized_vocab, settings)
+    agreement = adjusted_rand_score(
+        cluster_labels(full_preds, vocab, lemma_ids, target_alts, settings),
+        cluster_labels(mixed_preds, vocab, lemma_ids, target_alts, settings))
+
+    dtype_name = str(autocast_dtype).replace('torch.', '')
+    return [
+        f'Mixed precision ({dtype_name}) check on {len(sample)} {target_alts[0]} instances',
+        f'\tTop-{k} overlap (Jaccard) : {overlap:.3f}',
+        f'\tTop-1 agreement : {top_1:.3f}',
+        f'\tCluster agreement (ARI) : {agreement:.3f}']
@@ -0,0 +1,100 @@
+from collections import namedtuple
+from scipy.sparse import csr_matrix, vstack
+import pandas as pd
+import numpy as np
+import json
+
+## Sparse MLM predictions, one row per instance
+## Each row only holds the kept (vocab id, prob) pairs, in descending order of prob
+## matrix is a scipy CSR matrix of shape (instances, vocab size)
+## selected holds the vocab ids kept by trimming, if they were trimmed while predicting
+SparsePredictions = namedtuple('SparsePredictions', ['inst_ids', 'matrix', 'selected'],
+                               defaults=[None])
+
+def stack_predictions(inst_ids, indices, probs, counts, vocab_size, selected=None):
+    ## Joins the per batch (indices, probs, counts) arrays into CSR arrays
+    indptr = np.zeros(len(inst_ids) + 1, dtype=np.int64)
+    if counts:
+        np.cumsum(np.concatenate(counts), out=indptr[1:])
+        indices = np.concatenate(indices).astype(np.int32)
+        probs = np.concatenate(probs).astype(np.float32)
+    else:
+        indices = np.zeros(0, dtype=np.int32)
+        probs = np.zeros(0, dtype=np.float32)
+
+    matrix = csr_matrix((probs, indices, indptr),
+                        shape=(len(inst_ids), vocab_size))
+    return SparsePredictions(np.asarray(inst_ids), matrix, selected)
+
+def save_predictions(predictions, path):
+    matrix = predictions.matrix
+    trimmed = {} if predictions.selected is None else {'selected': predictions.selected}
+    np.savez(path,
+        inst_ids=predictions.inst_ids,
+        indptr=matrix.indptr,
+        indices=matrix.indices,
+        probs=matrix.data,
+        shape=np.array(matrix.shape),
+        **trimmed)
+
+def load_predictions(path):
+    with np.load(path, allow_pickle=True) as saved:
+        matrix = csr_matrix(
+            (saved['probs'], saved['indices'], saved['indptr']),
+            shape=tuple(saved['shape']))
+        selected = saved['selected'] if 'selected' in saved.files else None
+        return SparsePredictions(saved['inst_ids'], matrix, selected)
+
+def merge_predictions(parts):
+    ## Joins predictions made for chunks of the same target, in order
+    selected = None
+    if all(part.selected is not None for part in parts):
+        selected = np.unique(np.concatenate([part.selected for part in parts]))
+
+    return SparsePredictions(
+        np.concatenate([part.inst_ids for part in parts]),
+        vstack([part.matrix for part in parts], format='csr'),
+        selected)
+
+def predictions_to_frame(predictions, vocab_ids):
+    ## Dense frame of only the selected columns, keyed by their (vocab or lemma) id
+    ## Terms outside of an instance's kept predictions are 0
+    vocab_ids = np.asarray(vocab_ids, dtype=np.int64)
+    dense = predictions.matrix[:, vocab_ids].toarray()
+    return pd.DataFrame(dense, index=predictions.inst_ids, columns=vocab_ids)
+
+def lemma_index(lemmatized_vocab):
+    ## Each distinct lemma, and the lemma id of every vocab id
+    lemmas, lemma_ids = np.unique(np.array(lemmatized_vocab), return_inverse=True)
+    return lemmas.tolist(), lemma_ids
+
+def reduce_to_lemmas(predictions, lemma_ids, n_lemmas):
+    ## Sums the probs of the vocab terms that share a lemma, row by row
+    matrix = predictions.matrix
+    lemma_matrix = csr_matrix(
+        (matrix.data, lemma_ids[matrix.indices], matrix.indptr),
+        shape=(matrix.shape[0], n_lemmas))
+    lemma_matrix.sum_duplicates()
+
+    selected = predictions.selected
+    if selected is not None:
+        selected = np.unique(lemma_ids[selected])
+    return SparsePredictions(predictions.inst_ids, lemma_matrix, selected)
+
+def prediction_columns(original_vocab, lemmatized_vocab, settings):
+    ## Words for the columns used in clustering, and the vocab id -> lemma id index
+    ## Columns are vocab ids, or lemma ids when lemmatization is enabled
+    if settings.disable_lemmatization:
+        return original_vocab, None
+    return lemma_index(lemmatized_vocab)
+
+## Vocab tables are saved once per run, next to the predictions
+def save_vocab(original_vocab, lemmatized_vocab, output_path):
+    with open(f'{output_path}/predictions/vocab.json', 'w') as fout:
+        json.dump({'original': original_vocab,
+                   'lemmatized': lemmatized_vocab}, fout)
+
+def load_vocab(output_path):
+    with open(f'{output_path}/predictions/vocab.json', 'r') as fin:
+        vocab = json.load(fin)
+    return vocab['original'], vocab['lemmatized']
@@ -0,0 +1,103 @@
+from wsi.workers import fork_pool
+from sklearn.decomposition import PCA
+from glob import glob
+import pandas as pd
+import pickle
+
+## Cluster plots, kept off the clustering path
+## Clustering only saves a 2D projection of each target's predictions with its labels;
+## render_plots turns them into HTML later, and can be run again on its own
+
+def save_projection(preds, initial_labels, final_labels, target_alts, save_path):
+    pca = PCA(n_components=2).fit(preds)
+    projection = pd.DataFrame(pca.transform(preds), columns=['x', 'y'], index=preds.index)
+    projection['initial'] = initial_labels
+    projection['final'] = final_labels
+
+    with open(f'{save_path}/plots/{target_alts[0]}_projection.pkl', 'wb') as fout:
+        pickle.dump({'target_alts': target_alts, 'projection': projection}, fout, 
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+def plot_clustered_preds(projection, labels, target_alts, path):
+    ## Plotly is only imported when plots are actually made
+    import plotly.express as px
+
+    preds_comps = projection[['x', 'y']].copy()
+    preds_comps['size'] = 12
+    preds_comps['cluster'] = labels    
+    preds_comps.sort_values(by='cluster', inplace=True)
+    preds_comps['cluster'] = preds_comps['cluster'].astype('category')
+
+    layout = {
+        "paper_bgcolor": "#FAFAFA",
+        "plot_bgcolor": "#DDDDDD",
+        "dragmode": "pan",
+        'font': {
+            'family': "Courier New, monospace",
+            'size': 13
+        },
+        'margin': {
+            'l': 60,
+            'r': 40,
+            'b': 40,
+            't': 40,
+            'pad': 4
+        },
+        'xaxis': {
+            "showgrid": True,
+            "zeroline": False,
+            "visible": True,
+            "title": ''
+        },
+        'yaxis': {
+            "showgrid": True,
+            "zeroline": False,
+            "visible": True,
+            "title": ''
+        },
+        'legend': {
+            "title":'Cluster'
+        }
+        }
+
+    title = f"Clusters for {' and '.join(target_alts)}"
+    colors = px.colors.qualitative.Prism + [
+        'rgb(136, 204, 238)',
+        'rgb(102, 17, 0)',
+        'rgb(184, 46, 46)',
+        'rgb(13, 42, 99)'
+        ]
+
+    fig = px.scatter(
+        preds_comps, x='x', y='y', color='cluster', size='size',
+        hover_name=preds_comps.index,
+        title=title, 
+        color_discrete_sequence=colors)
+    fig.update_layout(**layout)
+    fig.update_traces(
+        textposition='top center',
+        textfont={'family': "Raleway, sans-serif" }
+        )
+    # fig.show()
+    fig.write_html(path)
+
+def render_projection(projection_path):
+    with open(projection_path, 'rb') as fin:
+        saved = pickle.load(fin)
+    target_alts, projection = saved['target_alts'], saved['projection']
+
+    ## Same places the plots used to be written to while clustering
+    plots_path = projection_path.rsplit('/', 1)[0]
+    save_path = plots_path.rsplit('/', 1)[0]
+    plot_clustered_preds(projection, projection.initial, target_alts,
+                         f'{plots_path}/{target_alts[0]}_initial_clusters.html')
+    plot_clustered_preds(projection, projection.final, target_alts,
+                         f'{save_path}/{target_alts[0]}_final_clusters.html')
+
+def render_plots(save_path, workers=1):
+    ## Makes the plots for every projection saved under save_path (the clusters folder)
+    projection_paths = sorted(glob(f'{save_path}/plots/*_projection.pkl'))
+    print(f'Plotting {len(projection_paths)} targets')
+    with fork_pool(workers) as pool:
+        run = map if pool is None else pool.imap
+        list(run(render_projection, projection_paths))
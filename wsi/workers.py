@@ -0,0 +1,26 @@
+import contextlib
+import multiprocessing
+
+## Data shared read-only with the workers of fork_pool
+_shared = None
+
+def shared_data():
+    return _shared
+
+@contextlib.contextmanager
+def fork_pool(workers, shared=None, initializer=None, initargs=()):
+    ## Worker processes that inherit shared from this one instead of it being sent per job
+    ## Forked, since spawned workers would re-run the calling script
+    ## Yields None for a single worker, so jobs can be run in this process the same way
+    global _shared
+    _shared = shared
+    try:
+        if workers <= 1:
+            if initializer is not None:
+                initializer(*initargs)
+            yield None
+        else:
+            with multiprocessing.get_context('fork').Pool(workers, initializer, initargs) as pool:
+                yield pool
+    finally:
+        _shared = None
@@ -1,95 +1,64 @@
 #%%
-from collections import Counter, defaultdict
+from collections import Counter
+from wsi.reporting import save_projection
+from concurrent.futures import ThreadPoolExecutor
 from scipy.spatial.distance import pdist, cdist
+from scipy.sparse import issparse
 from scipy.cluster.hierarchy import linkage, fcluster
 from sklearn.decomposition import PCA
-import plotly.express as px
-import pandas as pd
+from sklearn.random_projection import GaussianRandomProjection
+from sklearn.cluster import MiniBatchKMeans
 import numpy as np
 
-def remap_senses(sense_remapping, clusters):
-    remapped_clusters = defaultdict(list)
-    for sense_num, cluster in clusters.items():
-        remapped_sense = sense_remapping[sense_num] 
-        remapped_clusters[remapped_sense].extend(cluster)
-
-    clusters = {}
-    for sense_num, cluster in enumerate(remapped_clusters.values()):
-        clusters[sense_num] = cluster
-
-    return clusters
-
-def plot_clustered_preds(preds, labels, target_alts, path):
-    pca = PCA(n_components=2).fit(preds)
-    preds_comps = pd.DataFrame(pca.transform(preds), columns=['x', 'y'], index=preds.index)
-    preds_comps['size'] = 12
-
-    if type(labels) == dict:
-        labels = preds_comps.index.map(labels)
-    
-    preds_comps['cluster'] = labels    
-    preds_comps.sort_values(by='cluster', inplace=True)
-    preds_comps['cluster'] = preds_comps['cluster'].astype('category')
-
-    layout = {
-        "paper_bgcolor": "#FAFAFA",
-        "plot_bgcolor": "#DDDDDD",
-        "dragmode": "pan",
-        'font': {
-            'family': "Courier New, monospace",
-            'size': 13
-        },
-        'margin': {
-            'l': 60,
-            'r': 40,
-            'b': 40,
-            't': 40,
-            'pad': 4
-        },
-        'xaxis': {
-            "showgrid": True,
-            "zeroline": False,
-            "visible": True,
-            "title": ''
-        },
-        'yaxis': {
-            "showgrid": True,
-            "zeroline": False,
-            "visible": True,
-            "title": ''
-        },
-        'legend': {
-            "title":'Cluster'
-        }
-        }
-
-    title = f"Clusters for {' and '.join(target_alts)}"
-    colors = px.colors.qualitative.Prism + [
-        'rgb(136, 204, 238)',
-        'rgb(102, 17, 0)',
-        'rgb(184, 46, 46)',
-        'rgb(13, 42, 99)'
-        ]
-
-    fig = px.scatter(
-        preds_comps, x='x', y='y', color='cluster', size='size',
-        hover_name=preds_comps.index,
-        title=title, 
-        color_discrete_sequence=colors)
-    fig.update_layout(**layout)
-    fig.update_traces(
-        textposition='top center',
-        textfont={'family': "Raleway, sans-serif" }
-        )
-    # fig.show()
-    fig.write_html(path)
-
-def perform_clustering(predictions, settings, method='ward'):
+#### Clustering backends ####
+## Each returns a linkage matrix, and the leaf of that linkage each row belongs to
+def ward_linkage(features, settings):
     ## Pairwise distances
-    dists = pdist(predictions, metric='euclidean')
+    dists = pdist(features, metric='euclidean')
 
     ## Hierarchical agglomerative clustering
-    Z = linkage(dists, method=method, metric='euclidean')
+    return linkage(dists, method='ward', metric='euclidean'), None
+
+def pca_ward_linkage(features, settings):
+    ## Ward on a PCA reduced space; distances are found from the reduced features
+    n_components = min(settings.cluster_dims, *features.shape)
+    reduced = PCA(n_components=n_components).fit_transform(features)
+    return linkage(reduced, method='ward', metric='euclidean'), None
+
+def projection_ward_linkage(features, settings):
+    ## Ward on a random projection of the features
+    n_components = min(settings.cluster_dims, features.shape[1])
+    reduced = GaussianRandomProjection(
+        n_components=n_components, random_state=0).fit_transform(features)
+    return linkage(reduced, method='ward', metric='euclidean'), None
+
+def kmeans_ward_linkage(features, settings):
+    ## Mini-batch k-means first, then Ward merges the centroids
+    ## Rows take the leaf of their centroid
+    n_clusters = min(settings.kmeans_clusters, len(features))
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_clusters, batch_size=4096, n_init=3, random_state=0).fit(features)
+    return linkage(kmeans.cluster_centers_, method='ward', metric='euclidean'), kmeans.labels_
+
+def nn_chain_ward_linkage(features, settings):
+    ## Nearest-neighbour-chain Ward straight from the features, O(n) memory
+    try:
+        import fastcluster
+    except ImportError:
+        raise ImportError("The nn_chain_ward backend needs fastcluster (pip install fastcluster)")
+    return fastcluster.linkage_vector(features, method='ward', metric='euclidean'), None
+
+CLUSTER_BACKENDS = {
+    'ward': ward_linkage,
+    'pca_ward': pca_ward_linkage,
+    'projection_ward': projection_ward_linkage,
+    'kmeans_ward': kmeans_ward_linkage,
+    'nn_chain_ward': nn_chain_ward_linkage
+}
+
+def perform_clustering(predictions, settings):
+    features = np.asarray(predictions, dtype=np.float64)
+    Z, leaves = CLUSTER_BACKENDS[settings.cluster_backend](features, settings)
 
     # plt.figure(figsize=(10,6))
     # dn = dendrogram(Z, truncate_mode='lastp', p=15)
@@ -98,6 +67,10 @@ def perform_clustering(predictions, settings, method='ward'):
     distance_crit = Z[-cutoff, 2]
     labels = fcluster(Z, distance_crit, 'distance') - 1
 
+    ## Map the leaves back to rows; leaves without rows leave gaps in the labels
+    if leaves is not None:
+        _, labels = np.unique(labels[leaves], return_inverse=True)
+
     return labels
 
 def get_cluster_centers(data, n_senses, sense_clusters=None):
@@ -109,111 +82,148 @@ def get_cluster_centers(data, n_senses, sense_clusters=None):
 
     return cluster_centers
 
+#### Merging small senses ####
+## Senses are kept as an int label per row and the rows ordered by label (order),
+## so merging never rebuilds lists of instance ids
+## sense_order is the order senses are visited in, which is first appearance at the start
+## like the old dict of clusters; members keep the order the old lists had
+def sense_offsets(labels, n_senses):
+    ## Start and end of each sense's rows within order
+    offsets = np.zeros(n_senses + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_senses), out=offsets[1:])
+    return offsets
+
+def sense_medians(features, order, offsets, senses, centers):
+    for sense in senses:
+        rows = order[offsets[sense]:offsets[sense + 1]]
+        centers[sense] = np.median(features[rows], 0)
+    return centers
+
+def merge_small_senses(features, labels, min_sense_size):
+    n_senses = np.max(labels) + 1
+    _, first_rows = np.unique(labels, return_index=True)
+    sense_order = np.argsort(first_rows)
+    order = np.argsort(labels, kind='stable')
+    offsets = sense_offsets(labels, n_senses)
+    centers = sense_medians(features, order, offsets, range(n_senses),
+                            np.zeros((n_senses, features.shape[1])))
+
+    ## Sets might have many small clusters instead of any big
+    ## So we can iteratively get big (a single sense is kept even if it's small)
+    big_senses = np.diff(offsets) >= min_sense_size
+    while n_senses > 1 and not big_senses.all():
+        ## 2 left but they aren't both big enough, or none are big, so they all get merged to 1
+        if n_senses == 2 or not big_senses.any():
+            sense_remapping = np.zeros(n_senses, dtype=np.int64)
+        else:
+            ## Every sense goes to its closest big sense (big senses stay as they are)
+            big_ids = np.flatnonzero(big_senses)
+            dists = cdist(centers, centers[big_ids], metric='euclidean')
+            sense_remapping = big_ids[dists.argmin(axis=1)]
+
+        ## New ids follow the order the remapped senses are first visited
+        visited = sense_remapping[sense_order]
+        _, first_visits = np.unique(visited, return_index=True)
+        new_ids = np.empty(n_senses, dtype=np.int64)
+        new_ids[visited[np.sort(first_visits)]] = np.arange(len(first_visits))
+        lookup = new_ids[sense_remapping]
+
+        ## Merged senses take their members in visiting order
+        visit_rank = np.empty(n_senses, dtype=np.int64)
+        visit_rank[sense_order] = np.arange(n_senses)
+        order = order[np.lexsort((visit_rank[labels[order]], lookup[labels[order]]))]
+        labels = lookup[labels]
+
+        old_centers = centers
+        n_senses = len(first_visits)
+        sense_order = np.arange(n_senses)
+        offsets = sense_offsets(labels, n_senses)
+
+        ## Only senses that took in another sense need a new center
+        centers = np.zeros((n_senses, features.shape[1]))
+        centers[lookup] = old_centers
+        merged = np.flatnonzero(np.bincount(lookup, minlength=n_senses) > 1)
+        centers = sense_medians(features, order, offsets, merged, centers)
+
+        big_senses = np.diff(offsets) >= min_sense_size
+
+    return labels, order, sense_order, offsets, centers
+
 #%%
 def cluster_predictions(
     predictions, target_alts, settings, 
     min_sense_size, plot_clusters, print_clusters, save_path=None):
     labels = perform_clustering(predictions, settings)
-    n_senses = np.max(labels) + 1
+    initial_labels = labels
 
     ## Export information about the starting cluster formation
     if save_path:
-        if plot_clusters:
-            init_path = f'{save_path}/plots/{target_alts[0]}_initial_clusters.html'
-            plot_clustered_preds(predictions, labels, 
-                                target_alts, init_path)  
         if print_clusters:
             init_path = f'{save_path}/info/{target_alts[0]}_initial_clusters.txt'
             with open(init_path, 'w') as f:
                 for label, count in Counter(labels).items():
                     print(f'{label}: {count}', file=f)
 
-    ## Count cluster sizes by instances
-    sense_clusters = defaultdict(list)  
-    for inst_id, label in zip(predictions.index, labels):
-        sense_clusters[label].append(inst_id)
-    # for i in range(15):
-    #     print(i, ':', len(sense_clusters[i]))
+    ## Merge small senses into their closest big ones
+    features = np.asarray(predictions)
+    labels, order, sense_order, offsets, cluster_centers = merge_small_senses(
+        features, labels, min_sense_size)
 
-    ## Find center (median) of sense clusters
-    cluster_centers = get_cluster_centers(
-        predictions, n_senses, sense_clusters)
-
-    ## Sets might have many small clusters instead of any big
-    ## So we can iteratively get big
-    big_senses = []
-    for label, count in Counter(labels).items(): 
-        if count >= min_sense_size:
-            big_senses.append(label)
-        
-    ## Remap senses if they aren't all big 
-    while (len(big_senses) != n_senses): 
-        # print('\nbig:', big_senses)
-        # print(len(big_senses), 'big ?=', n_senses, 'total')
-
-        ## 2 left but they aren't both big enough, so they'll get merged to 1
-        if n_senses == 2:
-            big_senses = [0]
-            sense_remapping = {0:0,1:0}
-        else:
-            dists = cdist(cluster_centers, cluster_centers, metric='euclidean')
-            closest_senses = np.argsort(dists, )[:, ]
-
-            sense_remapping = {}
-            for sense_idx in range(n_senses):
-                for closest_sense in closest_senses[sense_idx]:
-                    if closest_sense in big_senses:
-                        sense_remapping[sense_idx] = closest_sense
-                        break
-
-            # print('mapping => ', sense_remapping)
-            # print('=============\n')
-
-        sense_clusters = remap_senses(sense_remapping, sense_clusters)
-        n_senses = len(sense_clusters)
-        cluster_centers = get_cluster_centers(
-            predictions, n_senses, sense_clusters)
-        # print(cluster_centers.shape)
-        
-        ## 
-        # if n_senses > 1:
-        big_senses = []
-        for sense, cluster in sense_clusters.items():
-            # print(sense, ' : ', len(cluster))
-            if len(cluster) >= min_sense_size:
-                big_senses.append(sense)
-        # else:
-        #     break
+    ## Lists of instance ids, only built once the senses are final
+    inst_ids = predictions.index[order]
+    sense_clusters = {}
+    for sense in sense_order:
+        sense_clusters[sense] = list(inst_ids[offsets[sense]:offsets[sense + 1]])
 
+    ## Plots are made later from the saved projection, see wsi.reporting
     if plot_clusters and save_path:
-        labels = { sent_id:clust for clust, sents in sense_clusters.items() 
-                            for sent_id in sents}
-
-        final_path = f'{save_path}/{target_alts[0]}_final_clusters.html'
-        plot_clustered_preds(predictions, labels, target_alts, final_path)
+        save_projection(predictions, initial_labels, labels, target_alts, save_path)
 
     return sense_clusters, cluster_centers  
 
-def find_best_sents(target_data, predictions, cluster_centers, sense_clusters): 
+def dense_rows(features, rows):
+    ## Rows of the features as a dense array, from a CSR matrix or an array
+    chunk = features[rows]
+    if issparse(chunk):
+        chunk = chunk.toarray()
+    return chunk
+
+def find_best_sents(inst_ids, features, labels, cluster_centers, senses, chunk_rows, n_best=25): 
+    ## Distance of every row to its own sense's center, in one pass over the rows
+    dists = np.empty(len(labels))
+    for start in range(0, len(labels), chunk_rows):
+        chunk = dense_rows(features, slice(start, start + chunk_rows))
+        chunk_labels = labels[start:start + chunk_rows]
+        dists[start:start + chunk_rows] = np.linalg.norm(
+            chunk - cluster_centers[chunk_labels], axis=1)
+
+    ## Ids of the n_best rows closest to each center, closest first
+    order = np.argsort(labels, kind='stable')
+    offsets = sense_offsets(labels, len(cluster_centers))
     best_sents = {}
-    for sense, sentences in sense_clusters.items():
-        center = cluster_centers[sense]
-        preds = predictions.loc[sentences]
-        dists = cdist([center], preds, metric='euclidean')
-        dist_df = pd.DataFrame( dists[0], 
-                                columns=['dist'], 
-                                index=preds.index)
-        central = dist_df.nsmallest(25, columns=['dist'])
-        data_rows = target_data.loc[central.index]
-        best_sents[sense] = data_rows.formatted_sent.iteritems()
+    for sense in senses:
+        rows = order[offsets[sense]:offsets[sense + 1]]
+        if len(rows) > n_best:
+            rows = rows[np.argpartition(dists[rows], n_best)[:n_best]]
+        best_sents[sense] = inst_ids[rows[np.lexsort((rows, dists[rows]))]]
     return best_sents
 
-def map_other_instances(other_preds, cluster_centers, sense_clusters):
-    dists = cdist(cluster_centers, other_preds, metric='euclidean')
-    closest_senses = dists.T.argmin(axis=1)
-    for sense in sense_clusters.keys():
-        rows = other_preds.loc[closest_senses == sense]
-        sense_clusters[sense].extend(rows.index)
-    return sense_clusters
+def map_other_instances(features, rows, cluster_centers, chunk_rows, workers=1):
+    ## Closest sense of each of the rows
+    ## Only chunk_rows rows (per worker) are dense at a time, so memory doesn't grow with the target
+    def closest_senses(start):
+        chunk = dense_rows(features, rows[start:start + chunk_rows])
+        return cdist(cluster_centers, chunk, metric='euclidean').argmin(axis=0)
+
+    starts = range(0, len(rows), chunk_rows)
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            labels = list(pool.map(closest_senses, starts))
+    else:
+        labels = [closest_senses(start) for start in starts]
+
+    if not labels:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(labels)
 
 # %%